@@ -0,0 +1,243 @@
+#!/usr/bin/env python2
+
+# Copyright (c) 2026 Darren Spruell <phatbuckett@gmail.com>
+#
+# Permission to use, copy, modify, and distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+# Benchmark the dnsdb_query.py query path against a local
+# dnsdb-mock-server.py instance.
+#
+# Reports records/sec for each stage of the path (HTTP read, JSON decode,
+# compact record conversion, time filters, text and JSON formatting,
+# batch exports) and for the whole streaming pipeline, along with time to
+# first record and peak RSS. Results can be saved as JSON (-j) and
+# compared against a saved baseline (-b), exiting non-zero when a stage
+# is slower than the baseline by more than the tolerance.
+
+import json
+import optparse
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+BASEDIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BASEDIR)
+
+import dnsdb_query
+
+MOCK_SERVER = os.path.join(BASEDIR, 'dnsdb-mock-server.py')
+QUERY_NAME = 'bench.example.com'
+
+
+def peak_rss():
+    "Peak resident set size of this process so far, in KB"
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def start_server(options):
+    cmd = [sys.executable, MOCK_SERVER, '-p', '0',
+        '-n', str(options.records),
+        '-l', str(options.latency),
+        '-c', str(options.chunk_size)]
+    if options.gzip:
+        cmd.append('-z')
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+    url = proc.stdout.readline().strip()
+    if not url:
+        proc.wait()
+        sys.exit('dnsdb-bench: mock server failed to start')
+    return proc, url
+
+
+def timed(func, repeat):
+    "Run func repeat times; return the fastest run as (seconds, result)"
+    best = None
+    for i in range(repeat):
+        start = time.time()
+        res = func()
+        elapsed = time.time() - start
+        if best is None or elapsed < best[0]:
+            best = (elapsed, res)
+    return best
+
+
+def bench_stream(client, out):
+    "Run the full streaming query path, as dnsdb_query.py main() does"
+    start = time.time()
+    first = None
+    n = 0
+    res_list = client.query_rrset(QUERY_NAME)
+    res_list = dnsdb_query.filter_after(res_list, 0)
+    for res in res_list:
+        out.write('%s\n' % dnsdb_query.rrset_to_text(res))
+        if first is None:
+            first = time.time() - start
+        n += 1
+    return n, first
+
+
+def bench_read(fetch, url):
+    start = time.time()
+    first = None
+    lines = []
+    for line in fetch(url):
+        if first is None:
+            first = time.time() - start
+        lines.append(line)
+    return lines, first
+
+
+def run_benchmarks(options, server_url):
+    results = {}
+    path = '/lookup/rrset/name/%s?limit=%d' % (QUERY_NAME, options.records)
+    client = dnsdb_query.DnsdbClient(server_url, 'bench', options.records)
+    ka_client = dnsdb_query.DnsdbClient(server_url, 'bench', options.records, keepalive=True)
+
+    def add(stage, seconds, n, **extra):
+        results[stage] = dict(extra, seconds=seconds, records=n,
+            records_per_sec=n / seconds if seconds else 0)
+
+    # Streaming runs come first so that peak RSS reflects them before the
+    # per-stage benchmarks below materialize the whole result set.
+    devnull = open(os.devnull, 'w')
+    secs, (n, first) = timed(lambda: bench_stream(client, devnull), options.repeat)
+    add('stream', secs, n, first_record=first, peak_rss_kb=peak_rss())
+    secs, (n, first) = timed(lambda: bench_stream(ka_client, devnull), options.repeat)
+    add('stream_keepalive', secs, n, first_record=first, peak_rss_kb=peak_rss())
+
+    secs, (lines, first) = timed(lambda: bench_read(client._fetch, path), options.repeat)
+    add('http_read', secs, len(lines), first_record=first,
+        bytes=sum(len(l) for l in lines))
+    secs, (lines, first) = timed(lambda: bench_read(ka_client._fetch_keepalive, path), options.repeat)
+    add('http_read_keepalive', secs, len(lines), first_record=first)
+
+    secs, records = timed(lambda: [json.loads(l) for l in lines], options.repeat)
+    add('json_decode', secs, len(records))
+
+    secs, n = timed(lambda: len([dnsdb_query.Record(r) for r in records]), options.repeat)
+    add('compact_records', secs, n)
+
+    secs, n = timed(lambda: len(list(dnsdb_query.filter_after(
+        dnsdb_query.filter_before(records, 2 ** 31), 0))), options.repeat)
+    add('filter', secs, n)
+
+    secs, n = timed(lambda: len([dnsdb_query.rrset_to_text(r) for r in records]), options.repeat)
+    add('format_text', secs, n)
+
+    secs, n = timed(lambda: len([json.dumps(r) for r in records]), options.repeat)
+    add('format_json', secs, n)
+
+    secs, n = timed(lambda: dnsdb_query.export_csv(records, devnull), options.repeat)
+    add('export_csv', secs, len(records))
+
+    secs, n = timed(lambda: dnsdb_query.export_ndjson(records, devnull), options.repeat)
+    add('export_ndjson', secs, len(records))
+
+    if dnsdb_query.ARROW_MODULE:
+        out = tempfile.TemporaryFile()
+        secs, n = timed(lambda: dnsdb_query.export_arrow(records, out, parquet=True), options.repeat)
+        add('export_parquet', secs, len(records))
+        out.close()
+
+    results['peak_rss_kb'] = peak_rss()
+    return results
+
+
+def print_results(results, baseline=None):
+    print '%-22s %10s %10s %14s %10s' % ('stage', 'records', 'seconds', 'records/sec', 'change')
+    for stage in sorted(k for k in results if isinstance(results[k], dict)):
+        r = results[stage]
+        change = ''
+        if baseline and stage in baseline and baseline[stage]['records_per_sec']:
+            change = '%+.1f%%' % (100.0 * r['records_per_sec'] / baseline[stage]['records_per_sec'] - 100)
+        print '%-22s %10d %10.3f %14.0f %10s' % (stage, r['records'], r['seconds'],
+            r['records_per_sec'], change)
+    for stage in ('stream', 'stream_keepalive', 'http_read'):
+        if stage in results:
+            print 'time to first record (%s): %.1f ms' % (stage, results[stage]['first_record'] * 1000)
+    print 'peak RSS after streaming: %d KB' % results['stream_keepalive']['peak_rss_kb']
+    print 'peak RSS: %d KB' % results['peak_rss_kb']
+
+
+def regressions(results, baseline, tolerance):
+    slower = []
+    for stage, r in results.items():
+        if not isinstance(r, dict) or stage not in baseline:
+            continue
+        base = baseline[stage]['records_per_sec']
+        if base and r['records_per_sec'] < base * (1 - tolerance):
+            slower.append(stage)
+    return sorted(slower)
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('-n', '--records', dest='records', type='int', default=100000,
+        help='number of records per query (default: 100000)')
+    parser.add_option('-r', '--repeat', dest='repeat', type='int', default=3,
+        help='runs per stage; the fastest is reported (default: 3)')
+    parser.add_option('-l', '--latency', dest='latency', type='float', default=0,
+        help='mock server response latency in seconds')
+    parser.add_option('-c', '--chunk-size', dest='chunk_size', type='int', default=65536,
+        help='mock server response chunk size in bytes (default: 65536)')
+    parser.add_option('-z', '--gzip', dest='gzip', action='store_true', default=False,
+        help='have the mock server gzip its responses')
+    parser.add_option('-s', '--server', dest='server',
+        help='use an already running mock server at this URL')
+    parser.add_option('-j', '--json', dest='json',
+        help='write results as JSON to this file')
+    parser.add_option('-b', '--baseline', dest='baseline',
+        help='compare against results saved with -j')
+    parser.add_option('-t', '--tolerance', dest='tolerance', type='float', default=0.1,
+        help='fractional slowdown against the baseline to report as a regression (default: 0.1)')
+    options, args = parser.parse_args()
+    if args:
+        parser.print_help()
+        sys.exit(1)
+
+    proc = None
+    server_url = options.server
+    if not server_url:
+        proc, server_url = start_server(options)
+    try:
+        results = run_benchmarks(options, server_url)
+    finally:
+        if proc:
+            proc.terminate()
+            proc.wait()
+
+    baseline = None
+    if options.baseline:
+        with open(options.baseline) as fp:
+            baseline = json.load(fp)
+    print_results(results, baseline)
+
+    if options.json:
+        with open(options.json, 'w') as fp:
+            json.dump(results, fp, indent=2, sort_keys=True)
+
+    if baseline:
+        slower = regressions(results, baseline, options.tolerance)
+        if slower:
+            sys.stderr.write('dnsdb-bench: slower than baseline: %s\n' % ', '.join(slower))
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    try:
+        main()
+    except KeyboardInterrupt:
+        pass
@@ -34,14 +34,14 @@ usage()
 EOF
 }
 
+# Input is read by dnsdb_query.py, which handles its text and JSON output
+# formats and compressed archives.
+DNSDB_QUERY="$(dirname "$0")/dnsdb_query.py"
+
+# Extraction is done in a single pass by dnsdb_query.py.
 auto_extract()
 {
-    IP_OUT="${FNAME}-ips.txt"
-    FQDN_OUT="${FNAME}-fqdns.txt"
-    $0 "${FNAME}" ip | sort -n -t. -k1,1 -k2,2 -k3,3 -k4,4 -u > "$IP_OUT"
-    $0 "${FNAME}" fqdn | sort -u > "$FQDN_OUT"
-    printf "[*] %4d %s\n" "$(wc -l < "$IP_OUT")" "$IP_OUT"
-    printf "[*] %4d %s\n" "$(wc -l < "$FQDN_OUT")" "$FQDN_OUT"
+    "$DNSDB_QUERY" --extract "${FNAME}"
 }
 
 # Parse script arguments
@@ -63,11 +63,17 @@ if [ -n "$AUTO" ]; then
     exit
 fi
 
+case "$2" in
+    fqdn|ip) ;;
+          *) usage; exit 1 ;;
+esac
+
+# Saved output is rewritten as text, one record per line, whatever its
+# format.
 # shellcheck disable=SC2034
-grep 'IN A' "$FNAME" | while read -r FQDN F2 F3 IP; do
+"$DNSDB_QUERY" --read "$FNAME" | grep 'IN A' | while read -r FQDN F2 F3 IP; do
     case "$2" in
       fqdn) echo "${FQDN%*.}" ;;
         ip) echo "$IP"        ;;
-         *) usage && exit 1 ;;
     esac
 done
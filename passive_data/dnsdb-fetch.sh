@@ -14,10 +14,11 @@
 # ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
 # OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
 #
-# Wrapper script for Farsight's dnsdb_query.py client. Fetches results and
-# forks them into an output file in current working dir + standard output.
-# You can then postprocess results using pdns-extract to get FQDNs and IPs
-# from the output file.
+# Wrapper script for Farsight's dnsdb_query.py client. Fetches results to
+# standard output and archives them as gzip compressed JSON in a file in the
+# current working dir. You can then postprocess results using
+# dnsdb-extract.sh -a to get FQDNs and IPs from the archive, or print them
+# again with dnsdb_query.py --read.
 
 DEFAULT_RRTYPE="A"
 
@@ -86,7 +87,7 @@ else
     fi
 fi
 
-OUTNAME="pdns.$(printf "%s" "${QDATA}/${RRTYPE}" | sed -e 's!/!-!g' -e 's!\*!WILDCARD!').$(date '+%Y%m%d').txt"
+OUTNAME="pdns.$(printf "%s" "${QDATA}/${RRTYPE}" | sed -e 's!/!-!g' -e 's!\*!WILDCARD!').$(date '+%Y%m%d').json.gz"
 
-dnsdb_query.py ${OPTS} | tee "$OUTNAME"
+dnsdb_query.py ${OPTS} --archive="$OUTNAME"
 
@@ -0,0 +1,256 @@
+#!/usr/bin/env python2
+
+# Copyright (c) 2026 Darren Spruell <phatbuckett@gmail.com>
+#
+# Permission to use, copy, modify, and distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+# Local stand-in for the DNSDB API, for testing and benchmarking
+# dnsdb_query.py without using the real service.
+#
+# Answers /lookup/rrset/name/... and /lookup/rdata/{name,ip}/... with
+# synthesized NDJSON results, honouring the limit, offset and time fence
+# query parameters, and optionally gzip compressed (-z). Latency, response
+# chunking and errors can be injected.
+# Point DNSDB_SERVER in a dnsdb_query.py config file at the URL printed on
+# startup.
+
+import BaseHTTPServer
+import itertools
+import json
+import optparse
+import random
+import SocketServer
+import sys
+import time
+import urlparse
+import zlib
+
+TIME_BASE = 1262304000  # 2010-01-01
+TIME_STEP = 3600
+
+options = None
+
+
+def synth_record(i, kind, qname, rrtype):
+    "Build result number i for a lookup of qname"
+    time_first = TIME_BASE + i * TIME_STEP
+    m = {
+        'count': i % 1000 + 1,
+        'time_first': time_first,
+        'time_last': time_first + (i % 720) * TIME_STEP,
+    }
+    addr = '10.%d.%d.%d' % (i >> 16 & 255, i >> 8 & 255, i & 255)
+    if kind == 'rrset':
+        m['rrname'] = qname
+        m['rrtype'] = rrtype or 'A'
+        m['bailiwick'] = qname.split('.', 1)[-1] or qname
+        m['rdata'] = [addr]
+    elif kind == 'ip':
+        m['rrname'] = 'host%d.example.com.' % i
+        m['rrtype'] = 'A'
+        m['rdata'] = addr
+    else:
+        m['rrname'] = 'host%d.example.com.' % i
+        m['rrtype'] = rrtype or 'NS'
+        m['rdata'] = qname
+    return m
+
+
+def matching_records(kind, qname, rrtype, params, offset, limit):
+    """
+    Return an iterator over the records within the time fences, from
+    offset, up to limit, and an upper bound on their number.
+    """
+    # time_first increases with the record number, so its fences map
+    # straight to a range of records.
+    lo, hi = 0, options.records
+    if 'time_first_after' in params:
+        lo = max(lo, (int(params['time_first_after']) - TIME_BASE) // TIME_STEP + 1)
+    if 'time_first_before' in params:
+        hi = min(hi, -((TIME_BASE - int(params['time_first_before'])) // TIME_STEP))
+    if not any(name.startswith('time_last') for name in params):
+        lo += offset
+        offset = 0
+    records = (synth_record(i, kind, qname, rrtype) for i in xrange(lo, hi))
+    records = (m for m in records if matches_fences(m, params))
+    return itertools.islice(records, offset, offset + limit), max(0, min(limit, hi - lo - offset))
+
+
+def mark_last(records):
+    "Yield (record, is_last) for each of records"
+    records = iter(records)
+    prev = next(records)
+    for m in records:
+        yield prev, False
+        prev = m
+    yield prev, True
+
+
+def matches_fences(m, params):
+    for name, value in params.items():
+        if not name.startswith('time_'):
+            continue
+        field, when = name.rsplit('_', 1)
+        ts = m[field]
+        if (when == 'before' and ts >= int(value)) or (when == 'after' and ts <= int(value)):
+            return False
+    return True
+
+
+class MockHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, fmt, *args):
+        if options.verbose:
+            BaseHTTPServer.BaseHTTPRequestHandler.log_message(self, fmt, *args)
+
+    def send_error_response(self, code, message):
+        body = '%s\n' % message
+        self.send_response(code)
+        self.send_header('Content-Type', 'text/plain')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def write_chunk(self, data, final=False):
+        if self.compressor is not None:
+            # Sync flush each chunk so the client can decompress it as it
+            # arrives.
+            data = self.compressor.compress(data) + \
+                self.compressor.flush(zlib.Z_FINISH if final else zlib.Z_SYNC_FLUSH)
+        if data:
+            self.wfile.write('%x\r\n%s\r\n' % (len(data), data))
+
+    def do_GET(self):
+        url = urlparse.urlsplit(self.path)
+        params = dict(urlparse.parse_qsl(url.query))
+        parts = url.path.strip('/').split('/')
+
+        if options.apikey and self.headers.get('X-Api-Key') != options.apikey:
+            return self.send_error_response(403, 'Error: Forbidden')
+        if len(parts) < 4 or parts[0] != 'lookup' or \
+                (parts[1], parts[2]) not in (('rrset', 'name'), ('rdata', 'name'), ('rdata', 'ip')):
+            return self.send_error_response(400, 'Error: Bad request')
+        if random.random() < options.error_rate:
+            return self.send_error_response(503, 'Error: Service unavailable')
+
+        kind = parts[2] if parts[1] == 'rdata' else 'rrset'
+        qname = parts[3]
+        if kind != 'ip' and not qname.endswith('.'):
+            qname += '.'
+        rrtype = parts[4] if len(parts) > 4 else None
+
+        # Time fences are applied before the offset and limit, as by DNSDB.
+        offset = int(params.get('offset', 0))
+        limit = min(int(params.get('limit', 0)) or options.max_results, options.max_results)
+        # Records are generated as they are sent; only the first is needed
+        # to tell whether there are any.
+        records, bound = matching_records(kind, qname, rrtype, params, offset, limit)
+        first = next(records, None)
+        if first is None:
+            return self.send_error_response(404, 'Error: no results found for query.')
+        records = itertools.chain([first], records)
+
+        time.sleep(options.latency)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.compressor = None
+        if options.gzip and 'gzip' in self.headers.get('Accept-Encoding', ''):
+            self.compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+            self.send_header('Content-Encoding', 'gzip')
+        self.end_headers()
+
+        # With time_last fences the number of records is not known up
+        # front, so a response shorter than drop_at is cut off in its last
+        # record instead.
+        drop_at = None
+        if random.random() < options.drop_rate:
+            drop_at = random.randrange(bound)
+
+        buf = []
+        size = 0
+        for n, (m, last) in enumerate(mark_last(records)):
+            line = json.dumps(m) + '\n'
+            if drop_at is not None and (drop_at == n or last):
+                # Cut the response off in the middle of a record.
+                buf.append(line[:len(line) // 2])
+                self.write_chunk(''.join(buf))
+                self.wfile.flush()
+                self.close_connection = 1
+                return
+            buf.append(line)
+            size += len(line)
+            if size >= options.chunk_size:
+                self.write_chunk(''.join(buf))
+                buf = []
+                size = 0
+                if options.chunk_delay:
+                    self.wfile.flush()
+                    time.sleep(options.chunk_delay)
+        self.write_chunk(''.join(buf), final=True)
+        self.wfile.write('0\r\n\r\n')
+
+
+class MockServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+def main():
+    global options
+
+    parser = optparse.OptionParser()
+    parser.add_option('-a', '--address', dest='address', default='127.0.0.1',
+        help='address to listen on (default: 127.0.0.1)')
+    parser.add_option('-p', '--port', dest='port', type='int', default=8080,
+        help='port to listen on, 0 for any free port (default: 8080)')
+    parser.add_option('-n', '--records', dest='records', type='int', default=10000,
+        help='number of results available for every lookup (default: 10000)')
+    parser.add_option('-m', '--max-results', dest='max_results', type='int', default=1000000,
+        help='server-side result cap per request (default: 1000000)')
+    parser.add_option('-k', '--apikey', dest='apikey',
+        help='require this X-Api-Key header value')
+    parser.add_option('-l', '--latency', dest='latency', type='float', default=0,
+        help='seconds to wait before responding')
+    parser.add_option('-c', '--chunk-size', dest='chunk_size', type='int', default=65536,
+        help='bytes of results per response chunk (default: 65536)')
+    parser.add_option('-z', '--gzip', dest='gzip', action='store_true', default=False,
+        help='gzip responses to clients that accept it')
+    parser.add_option('-d', '--chunk-delay', dest='chunk_delay', type='float', default=0,
+        help='seconds to wait between response chunks')
+    parser.add_option('-e', '--error-rate', dest='error_rate', type='float', default=0,
+        help='fraction of requests to fail with HTTP 503')
+    parser.add_option('-D', '--drop-rate', dest='drop_rate', type='float', default=0,
+        help='fraction of responses to cut off mid-record')
+    parser.add_option('-s', '--seed', dest='seed', type='int',
+        help='random seed for error injection')
+    parser.add_option('-v', '--verbose', dest='verbose', action='store_true', default=False,
+        help='log requests to stderr')
+    options, args = parser.parse_args()
+    if args:
+        parser.print_help()
+        sys.exit(1)
+
+    random.seed(options.seed)
+    server = MockServer((options.address, options.port), MockHandler)
+    sys.stdout.write('http://%s:%d\n' % server.server_address)
+    sys.stdout.flush()
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    try:
+        main()
+    except KeyboardInterrupt:
+        pass
@@ -15,13 +15,28 @@
 # limitations under the License.
 
 import calendar
+import csv
 import errno
+import gzip
+import heapq
+import httplib
+import itertools
 import locale
 import optparse
 import os
+import Queue
+import re
+import socket
+import sqlite3
+import ssl
 import sys
+import tempfile
+import threading
 import time
+import urllib
 import urllib2
+import urlparse
+import zlib
 from cStringIO import StringIO
 
 try:
@@ -29,21 +44,280 @@ try:
 except ImportError:
     import simplejson as json
 
+try:
+    import pyarrow
+    import pyarrow.parquet
+    ARROW_MODULE = True
+except ImportError:
+    ARROW_MODULE = False
+
+try:
+    import zstandard
+    ZSTD_MODULE = True
+except ImportError:
+    ZSTD_MODULE = False
+
 DEFAULT_CONFIG_FILE = '/etc/dnsdb-query.conf'
 DEFAULT_DNSDB_SERVER = 'https://api.dnsdb.info'
+TIME_FENCE_PARAMS = ('time_first_before', 'time_first_after',
+    'time_last_before', 'time_last_after')
+DEFAULT_CACHE_FILE = '~/.dnsdb-query.cache'
+DEFAULT_CACHE_TTL = 86400
+DEFAULT_CACHE_MAX_SIZE = 256 * 1024 * 1024
+DEFAULT_CACHE_MAX_ENTRY_SIZE = 8 * 1024 * 1024
+DEFAULT_SORT_BUFFER = 100000
+DEFAULT_PAGE_SIZE = 10000
+EXPORT_BATCH_SIZE = 10000
+EXPORT_FORMATS = ('csv', 'ndjson', 'parquet', 'arrow')
+EXPORT_COLUMNS = ('rrname', 'rrtype', 'bailiwick', 'rdata', 'count',
+    'time_first', 'time_last', 'zone_time_first', 'zone_time_last')
+ARCHIVE_FLUSH_INTERVAL = 10
+GZIP_MAGIC = '\x1f\x8b'
+ZSTD_MAGIC = '\x28\xb5\x2f\xfd'
 
 cfg = None
 options = None
 
 locale.setlocale(locale.LC_ALL, '')
 
+class QueryError(Exception):
+    def __init__(self, message, status=None):
+        Exception.__init__(self, message)
+        # HTTP status of a failed lookup, if the server answered.
+        self.status = status
+
+class InputError(Exception):
+    pass
+
+class ResultCache(object):
+    """
+    On-disk cache of raw lookup responses, keyed by request URL. Entries
+    expire after their TTL and the least recently used entries are evicted
+    once the cache grows past max_size bytes. Responses larger than
+    max_entry_size bytes compressed are not cached.
+    """
+    def __init__(self, fname, ttl=DEFAULT_CACHE_TTL, max_size=DEFAULT_CACHE_MAX_SIZE,
+            max_entry_size=DEFAULT_CACHE_MAX_ENTRY_SIZE):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.max_entry_size = min(max_entry_size, max_size)
+        self.hits = 0
+        self.misses = 0
+        # Bulk mode hands each worker thread its own cache connection.
+        self.db = sqlite3.connect(os.path.expanduser(fname), timeout=30,
+            check_same_thread=False, isolation_level=None)
+        self.db.execute('CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, '
+            'expires INTEGER, accessed REAL, size INTEGER, data BLOB)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS results_accessed ON results (accessed)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS stats (name TEXT PRIMARY KEY, value INTEGER)')
+
+    def _count(self, name):
+        self.db.execute('INSERT OR IGNORE INTO stats VALUES (?, 0)', (name,))
+        self.db.execute('UPDATE stats SET value = value + 1 WHERE name = ?', (name,))
+
+    def get(self, key):
+        row = self.db.execute('SELECT data FROM results WHERE key = ? AND expires > ?',
+            (key, int(time.time()))).fetchone()
+        if row is None:
+            self.misses += 1
+            self._count('misses')
+            return None
+        self.hits += 1
+        self._count('hits')
+        self.db.execute('UPDATE results SET accessed = ? WHERE key = ?', (time.time(), key))
+        return zlib.decompress(row[0])
+
+    def put(self, key, data):
+        self.put_compressed(key, zlib.compress(data))
+
+    def put_compressed(self, key, data):
+        "Store data, already compressed with zlib, under key"
+        if len(data) > self.max_entry_size:
+            return
+        now = time.time()
+        self.db.execute('INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?)',
+            (key, int(now + self.ttl), now, len(data), sqlite3.Binary(data)))
+        self._evict(now)
+
+    def _evict(self, now):
+        self.db.execute('DELETE FROM results WHERE expires <= ?', (int(now),))
+        excess = self.db.execute('SELECT COALESCE(SUM(size), 0) FROM results').fetchone()[0] - self.max_size
+        if excess <= 0:
+            return
+        victims = []
+        for key, size in self.db.execute('SELECT key, size FROM results ORDER BY accessed'):
+            victims.append((key,))
+            excess -= size
+            if excess <= 0:
+                break
+        self.db.executemany('DELETE FROM results WHERE key = ?', victims)
+
+    def stats(self):
+        st = dict(self.db.execute('SELECT name, value FROM stats'))
+        entries, size = self.db.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM results').fetchone()
+        return {
+            'entries': entries,
+            'size': size,
+            'hits': st.get('hits', 0),
+            'misses': st.get('misses', 0),
+        }
+
+class QueryStats(object):
+    """
+    Timing spans and counters for one query. Spans are seconds spent on
+    name resolution, TCP connect and TLS handshake (when a connection is
+    opened), waiting for the response headers (ttfb), reading the body
+    (transfer), decompressing it (decompress) and decoding results
+    (decode).
+    """
+    SPANS = ('dns', 'connect', 'tls', 'ttfb', 'transfer', 'decompress', 'decode')
+
+    def __init__(self, query):
+        self.query = query
+        self.start = time.time()
+        self.spans = {}
+        self.bytes = 0
+        self.records = 0
+        self.cache = None
+        self.error = None
+
+    def add(self, span, seconds):
+        self.spans[span] = self.spans.get(span, 0.0) + seconds
+
+    def to_dict(self):
+        elapsed = time.time() - self.start
+        d = {
+            'type': 'query',
+            'query': self.query,
+            'elapsed': elapsed,
+            'bytes': self.bytes,
+            'records': self.records,
+            'records_per_sec': self.records / elapsed if elapsed else 0.0,
+        }
+        d.update(self.spans)
+        if self.cache:
+            d['cache'] = self.cache
+        if self.error:
+            d['error'] = self.error
+        return d
+
+class StatsWriter(object):
+    "Write stats dicts as JSON lines; safe to share between threads"
+    def __init__(self, out):
+        self.out = out
+        self.lock = threading.Lock()
+
+    def __call__(self, stats):
+        line = json.dumps(stats, sort_keys=True) + '\n'
+        with self.lock:
+            self.out.write(line)
+            self.out.flush()
+
+RECORD_NAME_FIELDS = frozenset(('rrname', 'rrtype', 'bailiwick', 'rdata'))
+RECORD_FIELDS = frozenset(EXPORT_COLUMNS)
+
+def _compact_str(s):
+    # DNS names and rdata are almost always ASCII: a str is much smaller
+    # than the unicode json returns, and can be interned.
+    if isinstance(s, unicode):
+        try:
+            s = s.encode('ascii')
+        except UnicodeEncodeError:
+            return s
+    if isinstance(s, str):
+        return intern(s)
+    return s
+
+class Record(object):
+    """
+    Compact, read-only form of a result dict for holding many results in
+    memory. Known fields are kept in slots, with names and rdata as
+    interned strings and counts and times as ints; any other keys are kept
+    in a dict. Supports the dict methods used on results elsewhere here
+    (r[key], key in r, get(), keys()); use to_dict() or result_to_json()
+    to serialize.
+    """
+    __slots__ = EXPORT_COLUMNS + ('_extra',)
+
+    def __init__(self, res):
+        extra = None
+        for key, value in res.iteritems():
+            if key not in RECORD_FIELDS:
+                if extra is None:
+                    extra = {}
+                extra[key] = value
+            elif key not in RECORD_NAME_FIELDS:
+                setattr(self, key, int(value))
+            elif isinstance(value, list):
+                setattr(self, key, [_compact_str(v) for v in value])
+            else:
+                setattr(self, key, _compact_str(value))
+        self._extra = extra
+
+    def __getitem__(self, key):
+        if key in RECORD_FIELDS:
+            try:
+                return getattr(self, key)
+            except AttributeError:
+                pass
+        elif self._extra and key in self._extra:
+            return self._extra[key]
+        raise KeyError(key)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __contains__(self, key):
+        if key in RECORD_FIELDS:
+            return hasattr(self, key)
+        return bool(self._extra) and key in self._extra
+
+    def keys(self):
+        keys = [key for key in EXPORT_COLUMNS if hasattr(self, key)]
+        if self._extra:
+            keys.extend(self._extra)
+        return keys
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def to_dict(self):
+        return dict((key, self[key]) for key in self.keys())
+
+    def __repr__(self):
+        return 'Record(%r)' % self.to_dict()
+
+def result_to_json(res):
+    return json.dumps(res, default=Record.to_dict)
+
+def normalize_query_path(path):
+    # Owner names, rrtypes and bailiwicks are case insensitive and the
+    # trailing dot is optional, so these all map to the same cache entry.
+    path, sep, params = path.partition('?')
+    return '/'.join(p.lower().rstrip('.') or p for p in path.split('/')) + sep + params
+
 class DnsdbClient(object):
-    def __init__(self, server, apikey, limit=None):
+    def __init__(self, server, apikey, limit=None, keepalive=False, cache=None, refresh=False,
+            stats=None, compact=False):
         self.server = server
         self.apikey = apikey
         self.limit = limit
+        self.keepalive = keepalive
+        self.cache = cache
+        self.refresh = refresh
+        # Called with a QueryStats dict as each query finishes.
+        self.stats = stats
+        # Return results as Record rather than dict.
+        self.compact = compact
+        self._conn = None
 
-    def query_rrset(self, oname, rrtype=None, bailiwick=None):
+    def query_rrset(self, oname, rrtype=None, bailiwick=None, **fences):
         if bailiwick:
             if not rrtype:
                 rrtype = 'ANY'
@@ -52,36 +326,481 @@ class DnsdbClient(object):
             path = 'rrset/name/%s/%s' % (oname, rrtype)
         else:
             path = 'rrset/name/%s' % oname
-        return self._query(path)
+        return self._query(path, **fences)
 
-    def query_rdata_name(self, rdata_name, rrtype=None):
+    def query_rdata_name(self, rdata_name, rrtype=None, **fences):
         if rrtype:
             path = 'rdata/name/%s/%s' % (rdata_name, rrtype)
         else:
             path = 'rdata/name/%s' % rdata_name
-        return self._query(path)
+        return self._query(path, **fences)
 
-    def query_rdata_ip(self, rdata_ip):
+    def query_rdata_ip(self, rdata_ip, **fences):
         path = 'rdata/ip/%s' % rdata_ip.replace('/', ',')
-        return self._query(path)
+        return self._query(path, **fences)
 
-    def _query(self, path):
-        res = []
-        url = '%s/lookup/%s' % (self.server, path)
+    def _query(self, path, offset=None, **fences):
+        # Time fences (see TIME_FENCE_PARAMS) are passed through to the
+        # server so that only matching results are returned.
+        params = []
         if self.limit:
-            url += '?limit=%d' % self.limit
-        req = urllib2.Request(url)
-        req.add_header('Accept', 'application/json')
-        req.add_header('X-Api-Key', self.apikey)
+            params.append(('limit', self.limit))
+        if offset:
+            params.append(('offset', offset))
+        for name in TIME_FENCE_PARAMS:
+            value = fences.pop(name, None)
+            if value is not None:
+                params.append((name, time_parse(value)))
+        if fences:
+            raise TypeError('unknown time fence: %s' % ', '.join(fences))
+
+        url = '/lookup/%s' % path
+        if params:
+            url += '?' + urllib.urlencode(params)
+
+        qs = None
+        if self.stats is not None:
+            qs = QueryStats(url)
+
+        if self.cache is not None:
+            lines = self._fetch_cached(url, qs)
+        elif self.keepalive:
+            lines = self._fetch_keepalive(url, qs)
+        else:
+            lines = self._fetch(url, qs)
+
+        decode = _decode_result
+        if self.compact:
+            decode = lambda line: Record(_decode_result(line))
+
+        try:
+            if qs is None:
+                for line in lines:
+                    yield decode(line)
+            else:
+                for line in lines:
+                    start = time.time()
+                    res = decode(line)
+                    qs.add('decode', time.time() - start)
+                    qs.records += 1
+                    yield res
+        except QueryError, e:
+            if e.status == 404:
+                # DNSDB answers a lookup that has no results with a 404.
+                return
+            if qs is not None:
+                qs.error = str(e)
+            raise
+        finally:
+            if qs is not None:
+                self.stats(qs.to_dict())
+
+    def _fetch_cached(self, url, qs=None):
+        key = self.server + normalize_query_path(url)
+        if not self.refresh:
+            data = self.cache.get(key)
+            if data is not None:
+                if qs is not None:
+                    qs.cache = 'hit'
+                for line in data.splitlines():
+                    yield line
+                return
+        if qs is not None:
+            qs.cache = 'miss'
+
+        if self.keepalive:
+            lines = self._fetch_keepalive(url, qs)
+        else:
+            lines = self._fetch(url, qs)
+
+        # Results are still streamed to the caller. The response is
+        # compressed to a temporary file as it arrives and stored once
+        # complete, unless it outgrows the cache's entry size limit first.
+        spool = tempfile.TemporaryFile()
+        try:
+            z = zlib.compressobj()
+            sep = ''
+            for line in lines:
+                if spool is not None:
+                    spool.write(z.compress(sep + line.rstrip('\n')))
+                    sep = '\n'
+                    if spool.tell() > self.cache.max_entry_size:
+                        spool.close()
+                        spool = None
+                yield line
+            if spool is not None:
+                spool.write(z.flush())
+                spool.seek(0)
+                self.cache.put_compressed(key, spool.read(self.cache.max_entry_size + 1))
+        finally:
+            if spool is not None:
+                spool.close()
+
+    def _headers(self):
+        return {'Accept': 'application/json', 'Accept-Encoding': 'gzip',
+            'X-Api-Key': self.apikey}
+
+    def _fetch(self, url, qs=None):
+        # urllib2 sets up the connection itself, so its time is part of ttfb.
+        req = urllib2.Request(self.server + url, headers=self._headers())
         try:
+            start = time.time()
             http = urllib2.urlopen(req)
+            if qs is not None:
+                qs.add('ttfb', time.time() - start)
+            if http.info().getheader('Content-Encoding') == 'gzip':
+                for line in _split_lines(_gunzip(_read_blocks(http, qs), qs)):
+                    yield line
+                return
             while True:
+                start = time.time()
                 line = http.readline()
+                if qs is not None:
+                    qs.add('transfer', time.time() - start)
+                    qs.bytes += len(line)
                 if not line:
                     break
-                res.append(json.loads(line))
-        except (urllib2.HTTPError, urllib2.URLError), e:
-            sys.stderr.write(str(e) + '\n')
+                yield line
+        except urllib2.HTTPError, e:
+            raise QueryError(str(e), e.code)
+        except (urllib2.URLError, httplib.HTTPException, socket.error, zlib.error), e:
+            raise QueryError(str(e))
+
+    def _connection(self, qs=None):
+        u = urlparse.urlsplit(self.server)
+        if self._conn is None:
+            if u.scheme == 'https':
+                self._conn = httplib.HTTPSConnection(u.netloc)
+            else:
+                self._conn = httplib.HTTPConnection(u.netloc)
+            self._conn_path = u.path.rstrip('/')
+
+        # Open the socket here rather than leaving it to httplib so that
+        # each step of setting up the connection can be timed.
+        if self._conn.sock is None:
+            port = u.port or (443 if u.scheme == 'https' else 80)
+            t0 = time.time()
+            addr = socket.getaddrinfo(u.hostname, port, 0, socket.SOCK_STREAM)[0][4]
+            t1 = time.time()
+            sock = socket.create_connection(addr[:2])
+            t2 = time.time()
+            if qs is not None:
+                qs.add('dns', t1 - t0)
+                qs.add('connect', t2 - t1)
+            if u.scheme == 'https':
+                sock = ssl.create_default_context().wrap_socket(sock, server_hostname=u.hostname)
+                if qs is not None:
+                    qs.add('tls', time.time() - t2)
+            self._conn.sock = sock
+        return self._conn
+
+    def _close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def _fetch_keepalive(self, url, qs=None):
+        # Reuse one HTTP/1.1 connection across queries; a connection the
+        # server has idled out is only noticed on the next request, so retry
+        # once on a fresh connection.
+        for attempt in (1, 2):
+            try:
+                conn = self._connection(qs)
+                start = time.time()
+                conn.request('GET', self._conn_path + url, headers=self._headers())
+                http = conn.getresponse()
+                if qs is not None:
+                    qs.add('ttfb', time.time() - start)
+                break
+            except (httplib.HTTPException, socket.error), e:
+                self._close()
+                if attempt == 2:
+                    raise QueryError(str(e))
+
+        if http.status != 200:
+            http.read()
+            raise QueryError('HTTP Error %d: %s' % (http.status, http.reason), http.status)
+
+        complete = False
+        try:
+            blocks = _read_blocks(http, qs)
+            if http.getheader('Content-Encoding') == 'gzip':
+                blocks = _gunzip(blocks, qs)
+            for line in _split_lines(blocks):
+                yield line
+            complete = True
+        except (httplib.HTTPException, socket.error, zlib.error), e:
+            raise QueryError(str(e))
+        finally:
+            # A partially read response leaves the connection unusable.
+            if not complete:
+                self._close()
+
+def _read_blocks(fp, qs=None, size=8192):
+    "Yield blocks read from fp until EOF, counting them in qs"
+    while True:
+        start = time.time()
+        data = fp.read(size)
+        if qs is not None:
+            qs.add('transfer', time.time() - start)
+            qs.bytes += len(data)
+        if not data:
+            return
+        yield data
+
+def _gunzip(blocks, qs=None):
+    "Decompress gzip data incrementally, including concatenated members"
+    d = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    for data in blocks:
+        while data:
+            start = time.time()
+            out = d.decompress(data)
+            data = d.unused_data
+            if data:
+                d = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            if qs is not None:
+                qs.add('decompress', time.time() - start)
+            yield out
+    yield d.flush()
+
+def _unzstd(blocks):
+    d = zstandard.ZstdDecompressor().decompressobj()
+    for data in blocks:
+        yield d.decompress(data)
+
+def _split_lines(blocks, partial=True):
+    """
+    Split a stream of data blocks into lines, without the newlines. A
+    final line with no newline is only returned if partial is true.
+    """
+    buf = ''
+    for data in blocks:
+        lines = (buf + data).split('\n')
+        buf = lines.pop()
+        for line in lines:
+            yield line
+    if buf and partial:
+        yield buf
+
+def _decode_result(line):
+    try:
+        return json.loads(line)
+    except ValueError:
+        # Most likely a line cut short by a dropped connection.
+        raise QueryError('Invalid response line: %r' % line[:80])
+
+class RateLimiter(object):
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate else 0
+        self.next_time = 0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self.lock:
+            now = time.time()
+            start = max(now, self.next_time)
+            self.next_time = start + self.interval
+        if start > now:
+            time.sleep(start - now)
+
+NAME_RDATA_TYPES = ('NS', 'CNAME', 'DNAME', 'PTR', 'MX', 'SRV')
+
+def normalize_name(name):
+    name = name.lower()
+    if not name.endswith('.'):
+        name += '.'
+    return name
+
+def reverse_name(name):
+    labels = name.rstrip('.').split('.')
+    labels.reverse()
+    return '.'.join(labels) + '.'
+
+def pack_ip(addr):
+    # IPv4 addresses are mapped into ::ffff:0:0/96 so that all addresses
+    # compare as 128-bit big-endian integers.
+    if ':' in addr:
+        return socket.inet_pton(socket.AF_INET6, addr)
+    return '\0' * 10 + '\xff\xff' + socket.inet_pton(socket.AF_INET, addr)
+
+def ip_range(rdata_ip):
+    rdata_ip = rdata_ip.replace(',', '/')
+    if '-' in rdata_ip:
+        lo, hi = rdata_ip.split('-', 1)
+        return pack_ip(lo), pack_ip(hi)
+
+    addr, slash, prefixlen = rdata_ip.partition('/')
+    packed = pack_ip(addr)
+    if not slash:
+        return packed, packed
+    hostbits = 128 - int(prefixlen)
+    if ':' not in addr:
+        hostbits = 32 - int(prefixlen)
+    n = int(packed.encode('hex'), 16)
+    hostmask = (1 << hostbits) - 1
+    return (('%032x' % (n & ~hostmask)).decode('hex'),
+        ('%032x' % (n | hostmask)).decode('hex'))
+
+def _prefix_range(column, prefix):
+    # Prefix match that can use the index on column.
+    upper = prefix[:-1] + unichr(ord(prefix[-1]) + 1)
+    return '%s >= ? AND %s < ?' % (column, column), [prefix, upper]
+
+def _name_match(column, rev_column, name):
+    if name.startswith('*.'):
+        return _prefix_range(rev_column, reverse_name(normalize_name(name[2:])))
+    if name.endswith('.*'):
+        return _prefix_range(column, normalize_name(name[:-2]))
+    return '%s = ?' % column, [normalize_name(name)]
+
+FENCE_SQL = {
+    'time_first_before': 'IFNULL(COALESCE(time_first, zone_time_first) < ?, 1)',
+    'time_first_after': 'IFNULL(COALESCE(time_first, zone_time_first) > ?, 1)',
+    'time_last_before': 'IFNULL(COALESCE(time_last, zone_time_last) < ?, 1)',
+    'time_last_after': 'IFNULL(COALESCE(time_last, zone_time_last) > ?, 1)',
+}
+
+class LocalStore(object):
+    """
+    Local passive DNS store built from saved dnsdb_query.py output. Offers
+    the same query methods as DnsdbClient, answered from indexes on owner
+    names (forward and label-reversed, for wildcards), rdata names and
+    rdata addresses.
+    """
+    TIME_KEYS = ('count', 'time_first', 'time_last', 'zone_time_first', 'zone_time_last')
+
+    def __init__(self, fname, limit=None):
+        self.limit = limit
+        self.db = sqlite3.connect(os.path.expanduser(fname), timeout=30,
+            check_same_thread=False)
+        self.db.executescript('''
+            CREATE TABLE IF NOT EXISTS rrsets (id INTEGER PRIMARY KEY,
+                rrname TEXT, rrname_rev TEXT, rrtype TEXT, bailiwick TEXT,
+                rdata TEXT, count INTEGER, time_first INTEGER, time_last INTEGER,
+                zone_time_first INTEGER, zone_time_last INTEGER);
+            CREATE UNIQUE INDEX IF NOT EXISTS rrsets_key ON rrsets (rrname, rrtype, bailiwick, rdata);
+            CREATE INDEX IF NOT EXISTS rrsets_rev ON rrsets (rrname_rev);
+            CREATE TABLE IF NOT EXISTS rdata (rrset_id INTEGER, value TEXT,
+                name TEXT, name_rev TEXT, ip BLOB);
+            CREATE INDEX IF NOT EXISTS rdata_name ON rdata (name);
+            CREATE INDEX IF NOT EXISTS rdata_name_rev ON rdata (name_rev);
+            CREATE INDEX IF NOT EXISTS rdata_ip ON rdata (ip);
+        ''')
+
+    def ingest(self, res_list):
+        n = 0
+        with self.db:
+            for res in res_list:
+                self.add(res)
+                n += 1
+        return n
+
+    def add(self, res):
+        rrname = normalize_name(res['rrname'])
+        rrtype = res['rrtype'].upper()
+        bailiwick = res.get('bailiwick', '')
+        if bailiwick:
+            bailiwick = normalize_name(bailiwick)
+        rdata = res.get('rdata', [])
+        if not isinstance(rdata, list):
+            rdata = [rdata]
+        rdata_key = json.dumps(sorted(rdata))
+
+        row = self.db.execute('SELECT id, ' + ', '.join(self.TIME_KEYS) +
+            ' FROM rrsets WHERE rrname = ? AND rrtype = ? AND bailiwick = ? AND rdata = ?',
+            (rrname, rrtype, bailiwick, rdata_key)).fetchone()
+        if row is not None:
+            # The same rrset seen again: widen its time window and keep the
+            # largest count. DNSDB counts only grow, so that is the count
+            # from the latest snapshot, whatever order files are ingested in.
+            merged = []
+            for key, old in zip(self.TIME_KEYS, row[1:]):
+                new = res.get(key)
+                if old is None or new is None:
+                    merged.append(new if old is None else old)
+                elif key.endswith('first'):
+                    merged.append(min(old, new))
+                else:
+                    merged.append(max(old, new))
+            self.db.execute('UPDATE rrsets SET ' + ', '.join('%s = ?' % k for k in self.TIME_KEYS) +
+                ' WHERE id = ?', merged + [row[0]])
+            return
+
+        cur = self.db.execute('INSERT INTO rrsets (rrname, rrname_rev, rrtype, bailiwick, rdata, ' +
+            ', '.join(self.TIME_KEYS) + ') VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            [rrname, reverse_name(rrname), rrtype, bailiwick, rdata_key] +
+            [res.get(k) for k in self.TIME_KEYS])
+        rows = []
+        for value in rdata:
+            name = name_rev = ip = None
+            if rrtype in NAME_RDATA_TYPES:
+                name = normalize_name(value.split()[-1])
+                name_rev = reverse_name(name)
+            elif rrtype in ('A', 'AAAA'):
+                try:
+                    ip = sqlite3.Binary(pack_ip(value))
+                except (socket.error, ValueError):
+                    pass
+            rows.append((cur.lastrowid, value, name, name_rev, ip))
+        self.db.executemany('INSERT INTO rdata VALUES (?, ?, ?, ?, ?)', rows)
+
+    def query_rrset(self, oname, rrtype=None, bailiwick=None, **fences):
+        where, params = _name_match('rrname', 'rrname_rev', oname)
+        where = [where]
+        if rrtype and rrtype.upper() != 'ANY':
+            where.append('rrtype = ?')
+            params.append(rrtype.upper())
+        if bailiwick:
+            where.append('bailiwick = ?')
+            params.append(normalize_name(bailiwick))
+        for row in self._select('rrsets.rdata', where, params, fences):
+            yield self._result(row, json.loads(row[-1]))
+
+    def query_rdata_name(self, rdata_name, rrtype=None, **fences):
+        where, params = _name_match('name', 'name_rev', rdata_name)
+        where = [where]
+        if rrtype and rrtype.upper() != 'ANY':
+            where.append('rrtype = ?')
+            params.append(rrtype.upper())
+        for row in self._select('value', where, params, fences, True):
+            yield self._result(row, row[-1])
+
+    def query_rdata_ip(self, rdata_ip, **fences):
+        try:
+            lo, hi = ip_range(rdata_ip)
+        except (socket.error, ValueError):
+            raise QueryError('Invalid IP address or network: "%s"' % rdata_ip)
+        where = ['ip BETWEEN ? AND ?']
+        params = [sqlite3.Binary(lo), sqlite3.Binary(hi)]
+        for row in self._select('value', where, params, fences, True):
+            yield self._result(row, row[-1])
+
+    def _select(self, rdata_col, where, params, fences, join=False):
+        offset = fences.pop('offset', None)
+        for name, value in sorted(fences.items()):
+            if value is not None:
+                where.append(FENCE_SQL[name])
+                params.append(time_parse(value))
+        sql = ('SELECT rrname, rrtype, bailiwick, ' + ', '.join(self.TIME_KEYS) +
+            ', ' + rdata_col + ' FROM rrsets')
+        if join:
+            sql += ' JOIN rdata ON rdata.rrset_id = rrsets.id'
+        sql += ' WHERE ' + ' AND '.join(where)
+        if self.limit or offset:
+            sql += ' LIMIT %d' % (self.limit or -1)
+        if offset:
+            sql += ' OFFSET %d' % offset
+        return self.db.execute(sql, params)
+
+    def _result(self, row, rdata):
+        res = {'rrname': row[0], 'rrtype': row[1], 'rdata': rdata}
+        if row[2]:
+            res['bailiwick'] = row[2]
+        for key, value in zip(self.TIME_KEYS, row[3:]):
+            if value is not None:
+                res[key] = value
         return res
 
 def sec_to_text(ts):
@@ -116,6 +835,226 @@ def rrset_to_text(m):
 def rdata_to_text(m):
     return '%s IN %s %s' % (m['rrname'], m['rrtype'], m['rdata'])
 
+TEXT_RESULT_KEYS = {
+    'bailiwick': 'bailiwick',
+    'count': 'count',
+    'first seen': 'time_first',
+    'last seen': 'time_last',
+    'first seen in zone file': 'zone_time_first',
+    'last seen in zone file': 'zone_time_last',
+}
+
+def parse_text_results(fp):
+    """
+    Parse rrset_to_text() or rdata_to_text() output back into results.
+    Consecutive records with the same owner name and type are returned as
+    one rrset.
+    """
+    res = {}
+    for line in fp:
+        line = line.strip()
+        if not line or line.startswith(';;'):
+            if 'rrname' in res:
+                yield res
+                res = {}
+            key, sep, val = line[2:].partition(':')
+            key = TEXT_RESULT_KEYS.get(key.strip())
+            if not key:
+                continue
+            val = val.strip()
+            if key == 'count':
+                res[key] = int(re.sub(r'\D', '', val))
+            elif key.startswith('time') or key.startswith('zone'):
+                res[key] = time_parse(val[:19])
+            else:
+                res[key] = val
+            continue
+
+        fields = line.split(None, 3)
+        if len(fields) != 4 or fields[1] != 'IN':
+            continue
+        rrname, _, rrtype, rdata = fields
+        if 'rrname' in res and (res['rrname'], res['rrtype']) != (rrname, rrtype):
+            yield res
+            res = {}
+        res['rrname'] = rrname
+        res['rrtype'] = rrtype
+        res.setdefault('rdata', []).append(rdata)
+    if 'rrname' in res:
+        yield res
+
+def read_lines(fname):
+    """
+    Yield the lines of a saved output file or archive ("-" for stdin),
+    decompressing it if it is gzip or zstd compressed. An archive that is
+    still being written is read up to its last flush.
+    """
+    if fname == '-':
+        fp = sys.stdin
+    else:
+        fp = open(fname, 'rb')
+    try:
+        magic = fp.read(4)
+        blocks = itertools.chain([magic], _read_blocks(fp, size=65536))
+        partial = True
+        if magic.startswith(GZIP_MAGIC):
+            blocks = _gunzip(blocks)
+            partial = False
+        elif magic == ZSTD_MAGIC:
+            if not ZSTD_MODULE:
+                raise IOError('%s: reading zstd archives requires the zstandard module' % fname)
+            blocks = _unzstd(blocks)
+            partial = False
+        # Archives end every result with a newline, so anything after the
+        # last one is a record cut short.
+        for line in _split_lines(blocks, partial):
+            yield line
+    finally:
+        if fp is not sys.stdin:
+            fp.close()
+
+class ResultArchive(object):
+    """
+    Write results to fname as NDJSON, gzip compressed if fname ends in .gz
+    or zstd compressed if it ends in .zst. The output is flushed at least
+    every flush_interval seconds, so that an archive being written can be
+    read up to that point.
+    """
+    def __init__(self, fname, flush_interval=ARCHIVE_FLUSH_INTERVAL):
+        if fname.endswith('.gz'):
+            self.out = gzip.GzipFile(fname, 'wb')
+        elif fname.endswith('.zst'):
+            if not ZSTD_MODULE:
+                raise IOError('%s: writing zstd archives requires the zstandard module' % fname)
+            self.out = zstandard.ZstdCompressor().stream_writer(open(fname, 'wb'))
+        else:
+            self.out = open(fname, 'wb')
+        self.flush_interval = flush_interval
+        self.last_flush = time.time()
+
+    def write(self, res):
+        self.out.write(result_to_json(res) + '\n')
+        now = time.time()
+        if now - self.last_flush >= self.flush_interval:
+            self.flush()
+            self.last_flush = now
+
+    def flush(self):
+        # Compressed data written so far becomes decodable.
+        self.out.flush()
+
+    def close(self):
+        self.out.close()
+
+def archive_results(res_list, archive):
+    "Pass results through, writing each to archive"
+    for res in res_list:
+        archive.write(res)
+        yield res
+
+def result_to_text(res):
+    if isinstance(res.get('rdata'), list):
+        return rrset_to_text(res)
+    return rdata_to_text(res)
+
+def read_results(lines):
+    """
+    Read saved dnsdb_query.py output, in either JSON or text format, from
+    a file or iterable of lines (see read_lines()).
+    """
+    lines = iter(lines)
+    first = next(lines, '')
+    lines = itertools.chain([first], lines)
+    if first.startswith('{'):
+        for line in lines:
+            if line.strip():
+                res = json.loads(line)
+                res.pop('query', None)
+                yield res
+    else:
+        for res in parse_text_results(lines):
+            yield res
+
+def read_results_file(fname):
+    """
+    Read saved output from fname (see read_lines() and read_results()),
+    raising InputError naming fname if it cannot be read or parsed.
+    """
+    try:
+        for res in read_results(read_lines(fname)):
+            yield res
+    except (IOError, ValueError, zlib.error), e:
+        raise InputError('%s: %s' % (fname, getattr(e, 'strerror', None) or e))
+
+def unpack_ip(packed):
+    if packed.startswith('\0' * 10 + '\xff\xff'):
+        return socket.inet_ntop(socket.AF_INET, packed[12:])
+    return socket.inet_ntop(socket.AF_INET6, packed)
+
+def extract_hosts(lines):
+    """
+    Collect the unique owner names (without the trailing dot) and the
+    unique addresses of A and AAAA records in saved dnsdb_query.py output,
+    in one streaming pass. Addresses are returned packed (see pack_ip()) so
+    that sorting them sorts numerically.
+    """
+    fqdns = set()
+    ips = set()
+    lines = iter(lines)
+    first = next(lines, '')
+    lines = itertools.chain([first], lines)
+    if first.startswith('{'):
+        for line in lines:
+            if not line.strip():
+                continue
+            res = json.loads(line)
+            if res.get('rrtype') not in ('A', 'AAAA'):
+                continue
+            fqdns.add(res['rrname'].rstrip('.'))
+            rdata = res['rdata']
+            if isinstance(rdata, basestring):
+                rdata = [rdata]
+            for addr in rdata:
+                try:
+                    ips.add(pack_ip(addr))
+                except socket.error:
+                    pass
+    else:
+        # Only the record lines matter here, so skip parse_text_results()
+        # and test the fields directly.
+        for line in lines:
+            fields = line.split(None, 3)
+            if len(fields) != 4 or fields[1] != 'IN' or fields[2] not in ('A', 'AAAA'):
+                continue
+            fqdns.add(fields[0].rstrip('.'))
+            try:
+                ips.add(pack_ip(fields[3].strip()))
+            except socket.error:
+                pass
+    return fqdns, ips
+
+def extract_to_files(fname):
+    """
+    Write the unique FQDNs and IPs in fname to fname-fqdns.txt and
+    fname-ips.txt (less any .gz or .zst suffix), IPs in numeric order.
+    Returns the output file names and line counts.
+    """
+    fqdns, ips = extract_hosts(read_lines(fname))
+    for suffix in ('.gz', '.zst'):
+        if fname.endswith(suffix):
+            fname = fname[:-len(suffix)]
+    outputs = []
+    for suffix, values in (('ips', (unpack_ip(ip) for ip in sorted(ips))),
+            ('fqdns', sorted(fqdns))):
+        out_fname = '%s-%s.txt' % (fname, suffix)
+        n = 0
+        with open(out_fname, 'w') as out:
+            for value in values:
+                out.write(value + '\n')
+                n += 1
+        outputs.append((out_fname, n))
+    return outputs
+
 def parse_config(cfg_fname):
     config = {}
     cfg_files = filter(os.path.isfile,
@@ -155,35 +1094,623 @@ def time_parse(s):
 
 def filter_before(res_list, before_time):
     before_time = time_parse(before_time)
-    new_res_list = []
 
     for res in res_list:
         if 'time_first' in res:
             if res['time_first'] < before_time:
-                new_res_list.append(res)
+                yield res
         elif 'zone_time_first' in res:
             if res['zone_time_first'] < before_time:
-                new_res_list.append(res)
+                yield res
         else:
-            new_res_list.append(res)
-
-    return new_res_list
+            yield res
 
 def filter_after(res_list, after_time):
     after_time = time_parse(after_time)
-    new_res_list = []
 
     for res in res_list:
         if 'time_last' in res:
             if res['time_last'] > after_time:
-                new_res_list.append(res)
+                yield res
         elif 'zone_time_last' in res:
             if res['zone_time_last'] > after_time:
-                new_res_list.append(res)
+                yield res
         else:
-            new_res_list.append(res)
+            yield res
+
+def filter_strict_before(res_list, before_time):
+    before_time = time_parse(before_time)
+
+    for res in res_list:
+        if 'time_last' in res:
+            if res['time_last'] < before_time:
+                yield res
+        elif 'zone_time_last' in res:
+            if res['zone_time_last'] < before_time:
+                yield res
+        else:
+            yield res
+
+def filter_strict_after(res_list, after_time):
+    after_time = time_parse(after_time)
+
+    for res in res_list:
+        if 'time_first' in res:
+            if res['time_first'] > after_time:
+                yield res
+        elif 'zone_time_first' in res:
+            if res['zone_time_first'] > after_time:
+                yield res
+        else:
+            yield res
+
+class _Reversed(object):
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
 
-    return new_res_list
+    def __lt__(self, other):
+        return other.value < self.value
+
+    def __eq__(self, other):
+        return self.value == other.value
+
+def _read_sort_run(fp, keyfunc):
+    fp.seek(0)
+    for line in fp:
+        seq, res = line.split('\t', 1)
+        res = json.loads(res)
+        yield (keyfunc(res), int(seq), res)
+
+def sort_results(res_list, sort_key, reverse=False, top=None, buffer_size=DEFAULT_SORT_BUFFER):
+    """
+    Sort results on sort_key, keeping memory bounded: with top, only the
+    first top results are kept in a heap; otherwise sorted runs of
+    buffer_size results are spilled to temporary files and merged.
+    Results without sort_key (such as zone_time_first on a result seen
+    only in passive data) come last in either direction.
+    """
+    if reverse:
+        keyfunc = lambda r: (sort_key not in r, _Reversed(r.get(sort_key)))
+    else:
+        keyfunc = lambda r: (sort_key not in r, r.get(sort_key))
+
+    if top is not None:
+        for res in heapq.nsmallest(top, res_list, key=keyfunc):
+            yield res
+        return
+
+    # Decorate with the input position so equal keys keep their order and
+    # the merge never has to compare results themselves.
+    decorated = ((keyfunc(res), seq, res) for seq, res in enumerate(res_list))
+    runs = []
+    try:
+        while True:
+            chunk = list(itertools.islice(decorated, buffer_size))
+            chunk.sort()
+            if not runs and len(chunk) < buffer_size:
+                for item in chunk:
+                    yield item[2]
+                return
+            if not chunk:
+                break
+            fp = tempfile.TemporaryFile()
+            for item in chunk:
+                fp.write('%d\t%s\n' % (item[1], result_to_json(item[2])))
+            runs.append(fp)
+            del chunk
+
+        for item in heapq.merge(*[_read_sort_run(fp, keyfunc) for fp in runs]):
+            yield item[2]
+    finally:
+        for fp in runs:
+            fp.close()
+
+def _merge_aggregate(agg, new):
+    if new[0] is not None:
+        agg[0] = (agg[0] or 0) + new[0]
+    for i in (1, 2):
+        if new[i] is not None and (agg[i] is None or new[i] < agg[i]):
+            agg[i] = new[i]
+    for i in (3, 4):
+        if new[i] is not None and (agg[i] is None or new[i] > agg[i]):
+            agg[i] = new[i]
+
+def aggregate_results(res_list):
+    """
+    Merge results in one pass over res_list. Results are split into one
+    record per rdata value and merged on (rrname, rrtype, bailiwick,
+    rdata): counts are summed and the earliest first seen and latest last
+    seen times kept. rdata lookup results carry no bailiwick, so they are
+    merged into the rrset result for the same record if there is exactly
+    one. Yields the merged records, in no particular order, once all of
+    res_list has been read.
+    """
+    # (rrname, rrtype, rdata) -> {bailiwick: aggregate}
+    groups = {}
+    for res in res_list:
+        get = res.get
+        rdata = get('rdata')
+        if not isinstance(rdata, list):
+            rdata = [rdata]
+        new = [get('count'), get('time_first'), get('zone_time_first'),
+            get('time_last'), get('zone_time_last')]
+        for value in rdata:
+            by_bailiwick = groups.setdefault((get('rrname'), get('rrtype'), value), {})
+            agg = by_bailiwick.get(get('bailiwick'))
+            if agg is None:
+                by_bailiwick[get('bailiwick')] = list(new)
+            else:
+                _merge_aggregate(agg, new)
+
+    for (rrname, rrtype, value), by_bailiwick in groups.iteritems():
+        if None in by_bailiwick and len(by_bailiwick) == 2:
+            unknown = by_bailiwick.pop(None)
+            _merge_aggregate(by_bailiwick.values()[0], unknown)
+        for bailiwick, agg in by_bailiwick.iteritems():
+            res = {'rrname': rrname, 'rrtype': rrtype, 'rdata': [value]}
+            if bailiwick is not None:
+                res['bailiwick'] = bailiwick
+            for key, v in zip(('count', 'time_first', 'zone_time_first', 'time_last', 'zone_time_last'), agg):
+                if v is not None:
+                    res[key] = v
+            yield res
+
+IP_QUERY_RE = re.compile(r'^[0-9.]+(/[0-9]+|-[0-9.]+)?$')
+
+def is_ip_query(s):
+    return ':' in s or IP_QUERY_RE.match(s) is not None
+
+def parse_bulk_query(line, bulk_type='auto'):
+    if bulk_type == 'auto':
+        if is_ip_query(line):
+            bulk_type = 'rdataip'
+        else:
+            bulk_type = 'rrset'
+
+    if bulk_type == 'rrset':
+        method, args, fmt_func = 'query_rrset', line.split('/'), rrset_to_text
+    elif bulk_type == 'rdataname':
+        method, args, fmt_func = 'query_rdata_name', line.split('/'), rdata_to_text
+    elif bulk_type == 'rdataip':
+        method, args, fmt_func = 'query_rdata_ip', [line], rdata_to_text
+    else:
+        raise ValueError('Invalid bulk query type: "%s"' % bulk_type)
+
+    return ('%s:%s' % (bulk_type, line), method, args, fmt_func)
+
+def read_bulk_queries(fp, bulk_type='auto'):
+    for line in fp:
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        yield parse_bulk_query(line, bulk_type)
+
+def _bulk_worker(client, limiter, fences, filter_func, in_q, out_q):
+    while True:
+        query = in_q.get()
+        if query is None:
+            out_q.put(None)
+            return
+        label, method, args, fmt_func = query
+        limiter.wait()
+        try:
+            res_list = getattr(client, method)(*args, **fences)
+            for res in filter_func(res_list):
+                out_q.put((query, res, None))
+        except Exception, e:
+            out_q.put((query, None, e))
+
+def _bulk_feeder(queries, in_q, nthreads):
+    for query in queries:
+        in_q.put(query)
+    for i in range(nthreads):
+        in_q.put(None)
+
+def bulk_query(client_factory, queries, nthreads=8, rate=0, fences={}, filter_func=iter):
+    """
+    Run queries, as returned by parse_bulk_query(), through a pool of
+    nthreads workers each holding its own client. fences are the time
+    fences passed with every query. Yields (query, result,
+    error) tuples as results arrive; a failed query yields a single tuple
+    with the exception in error and does not affect the other queries.
+    """
+    in_q = Queue.Queue(nthreads * 2)
+    out_q = Queue.Queue(1000)
+    limiter = RateLimiter(rate)
+
+    threads = [threading.Thread(target=_bulk_feeder, args=(queries, in_q, nthreads))]
+    for i in range(nthreads):
+        threads.append(threading.Thread(target=_bulk_worker,
+            args=(client_factory(), limiter, fences, filter_func, in_q, out_q)))
+    for t in threads:
+        t.daemon = True
+        t.start()
+
+    running = nthreads
+    while running:
+        # A timed get() keeps the main thread responsive to ^C.
+        item = out_q.get(True, 86400)
+        if item is None:
+            running -= 1
+        else:
+            yield item
+
+def _pivot_target(rrtype, rdata):
+    if rrtype in ('A', 'AAAA'):
+        return 'ip', rdata
+    if rrtype in NAME_RDATA_TYPES:
+        return 'name', normalize_name(rdata.split()[-1])
+    return None, None
+
+def _pivot_queries(kind, node):
+    if kind == 'ip':
+        return [(node, 'query_rdata_ip', [node], None)]
+    return [(node, 'query_rrset', [node], None),
+        (node, 'query_rdata_name', [node], None)]
+
+def pivot(client_factory, seeds, max_depth=2, budget=100, nthreads=8, rate=0, fences={}):
+    """
+    Breadth-first pivot from seed names and IPs: names are expanded with
+    rrset and rdata name lookups, IPs with rdata IP lookups, and every
+    address or name found in the results becomes a node of the next
+    level. Each level is looked up concurrently and at most budget
+    lookups are made in total. Yields node and edge dicts as they are
+    discovered.
+    """
+    # One set of clients (and so connections) is shared by every level.
+    client_factory = itertools.cycle([client_factory() for i in range(nthreads)]).next
+
+    visited = set()
+    edges = set()
+    frontier = []
+    for seed in seeds:
+        if is_ip_query(seed):
+            kind, node = 'ip', seed
+        else:
+            kind, node = 'name', normalize_name(seed)
+        if node not in visited:
+            visited.add(node)
+            frontier.append((kind, node))
+            yield {'type': 'node', 'id': node, 'kind': kind, 'depth': 0}
+
+    depth = 0
+    while frontier and depth < max_depth:
+        queries = []
+        for kind, node in frontier:
+            queries.extend(_pivot_queries(kind, node))
+        if len(queries) > budget:
+            sys.stderr.write('dnsdb_query: pivot query budget exhausted at depth %d\n' % depth)
+            queries = queries[:budget]
+            if not queries:
+                break
+        budget -= len(queries)
+
+        depth += 1
+        frontier = []
+        for query, res, err in bulk_query(client_factory, iter(queries), nthreads, rate, fences):
+            if err is not None:
+                sys.stderr.write('dnsdb_query: %s: %s\n' % (query[0], err))
+                continue
+            source = normalize_name(res['rrname'])
+            rdata = res.get('rdata', [])
+            if not isinstance(rdata, list):
+                rdata = [rdata]
+            for value in rdata:
+                kind, target = _pivot_target(res['rrtype'], value)
+                if kind is None or (source, res['rrtype'], target) in edges:
+                    continue
+                edges.add((source, res['rrtype'], target))
+
+                for k, node in (('name', source), (kind, target)):
+                    if node not in visited:
+                        visited.add(node)
+                        frontier.append((k, node))
+                        yield {'type': 'node', 'id': node, 'kind': k, 'depth': depth}
+
+                edge = {'type': 'edge', 'source': source, 'target': target,
+                    'rrtype': res['rrtype']}
+                for key in LocalStore.TIME_KEYS:
+                    if key in res:
+                        edge[key] = res[key]
+                yield edge
+
+def _result_key(res):
+    rdata = res.get('rdata')
+    if isinstance(rdata, list):
+        rdata = tuple(rdata)
+    return (res.get('rrname'), res.get('rrtype'), res.get('bailiwick'), rdata)
+
+def _split_window(start, end, n):
+    "Split [start, end) into at most n adjacent non-empty windows"
+    n = min(n, end - start)
+    bounds = [start + (end - start) * i // n for i in range(n)] + [end]
+    return zip(bounds[:-1], bounds[1:])
+
+def _slice_worker(client, limiter, query_func, fences, in_q, out_q):
+    while True:
+        window = in_q.get()
+        if window is None:
+            return
+        start, end = window
+        # Windows are taken on time_first, so that they do not overlap.
+        kw = dict(fences)
+        if start is not None:
+            kw['time_first_after'] = start - 1
+            kw['time_first_before'] = end
+        limiter.wait()
+        try:
+            out_q.put((window, list(query_func(client, **kw)), None))
+        except Exception, e:
+            out_q.put((window, None, e))
+
+def sliced_query(client_factory, query_func, limit, nthreads=8, rate=0, fences={},
+        server_limit=None):
+    """
+    Run a lookup that may have more than limit results in full. query_func
+    is called with a client and time fences. server_limit is the most
+    results the server returns for one query, if lower than limit. The
+    lookup is first run as is; if it returns as many results as either
+    limit allows (and so was cut short) it is run again over nthreads
+    adjacent time_first windows, and any window that is still saturated
+    is bisected until it is not, or is a single second wide. Windows are
+    fetched concurrently. Yields the results of each unsaturated window as
+    it completes, dropping duplicates of results already seen. Raises
+    QueryError if a window cannot be fetched.
+    """
+    if server_limit:
+        limit = min(limit, server_limit)
+    in_q = Queue.Queue()
+    out_q = Queue.Queue()
+    limiter = RateLimiter(rate)
+    threads = []
+    for i in range(nthreads):
+        t = threading.Thread(target=_slice_worker,
+            args=(client_factory(), limiter, query_func, fences, in_q, out_q))
+        t.daemon = True
+        t.start()
+        threads.append(t)
+
+    lo = time_parse(fences['time_first_after']) + 1 if 'time_first_after' in fences else 1
+    hi = time_parse(fences['time_first_before']) if 'time_first_before' in fences else int(time.time()) + 1
+
+    seen = set()
+    try:
+        in_q.put((None, None))
+        pending = 1
+        while pending:
+            window, results, err = out_q.get(True, 86400)
+            pending -= 1
+            if err is not None:
+                raise err
+            start, end = window
+            if len(results) >= limit:
+                if start is None:
+                    start, end = lo, hi
+                    parts = nthreads
+                else:
+                    parts = 2
+                if end - start > 1:
+                    for w in _split_window(start, end, max(parts, 2)):
+                        in_q.put(w)
+                        pending += 1
+                    continue
+                sys.stderr.write('dnsdb_query: results first seen at %s reach the %d result limit '
+                    'and cannot be split further; results may be truncated\n' % (sec_to_text(start), limit))
+            for res in results:
+                key = _result_key(res)
+                if key not in seen:
+                    seen.add(key)
+                    yield res
+    finally:
+        # Drop windows not yet started so the workers exit promptly.
+        while True:
+            try:
+                in_q.get_nowait()
+            except Queue.Empty:
+                break
+        for t in threads:
+            in_q.put(None)
+        for t in threads:
+            t.join()
+
+def _write_checkpoint(fname, state):
+    tmp = fname + '.tmp'
+    with open(tmp, 'w') as fp:
+        json.dump(state, fp)
+    os.rename(tmp, fname)
+
+def paged_query_to_file(query_func, query, fname, fmt_func, filter_func=iter,
+        page_size=DEFAULT_PAGE_SIZE, retries=3):
+    """
+    Write every page of results from query_func (a client query method
+    with its arguments bound) to fname. query_func returns pages of up to
+    page_size results; the server may cap them lower. Progress is recorded
+    in fname.checkpoint so an interrupted pull of the same query resumes
+    where it stopped. Failed pages are retried from the last result read,
+    up to retries times in a row. Returns the number of results read.
+    """
+    ckpt_fname = fname + '.checkpoint'
+    state = {'query': query, 'offset': 0, 'size': 0}
+    if os.path.exists(ckpt_fname):
+        with open(ckpt_fname) as fp:
+            ckpt = json.load(fp)
+        if ckpt['query'] != query:
+            raise QueryError('%s: checkpoint is for a different query' % ckpt_fname)
+        state = ckpt
+        out = open(fname, 'a')
+        # Drop anything written after the checkpoint was taken.
+        out.truncate(state['size'])
+    else:
+        out = open(fname, 'w')
+
+    complete = False
+    failures = 0
+    # A short page ends the pull only if an earlier page was longer, as it
+    # may just be the server's cap; otherwise the next page is fetched to
+    # check.
+    longest = 0
+    try:
+        while not complete:
+            n = 0
+            try:
+                for res in query_func(offset=state['offset']):
+                    n += 1
+                    state['offset'] += 1
+                    for res in filter_func([res]):
+                        line = '%s\n' % fmt_func(res)
+                        out.write(line)
+                        state['size'] += len(line)
+                failures = 0
+                complete = n == 0 or n < min(page_size, longest)
+                longest = max(longest, n)
+            except QueryError, e:
+                failures += 1
+                if failures > retries:
+                    raise
+                sys.stderr.write('dnsdb_query: %s; retrying from offset %d\n' % (e, state['offset']))
+                time.sleep(2 ** failures)
+            out.flush()
+            _write_checkpoint(ckpt_fname, state)
+    finally:
+        out.close()
+        if complete:
+            os.remove(ckpt_fname)
+        else:
+            _write_checkpoint(ckpt_fname, state)
+    return state['offset']
+
+def flatten_results(res_list):
+    """
+    Yield one row per rdata value of each result, with values in
+    EXPORT_COLUMNS order and None for missing fields.
+    """
+    for res in res_list:
+        get = res.get
+        rdata = get('rdata')
+        if not isinstance(rdata, list):
+            rdata = [rdata]
+        head = (get('rrname'), get('rrtype'), get('bailiwick'))
+        tail = (get('count'), get('time_first'), get('time_last'),
+            get('zone_time_first'), get('zone_time_last'))
+        for value in rdata:
+            yield head + (value,) + tail
+
+def batched(rows, size=EXPORT_BATCH_SIZE):
+    rows = iter(rows)
+    while True:
+        batch = list(itertools.islice(rows, size))
+        if not batch:
+            return
+        yield batch
+
+def _utf8(s):
+    if isinstance(s, unicode):
+        return s.encode('utf-8')
+    return s
+
+def export_csv(res_list, out, batch_size=EXPORT_BATCH_SIZE):
+    writer = csv.writer(out)
+    writer.writerow(EXPORT_COLUMNS)
+    for batch in batched(flatten_results(res_list), batch_size):
+        writer.writerows([(_utf8(r[0]), _utf8(r[1]), _utf8(r[2]), _utf8(r[3])) + r[4:]
+            for r in batch])
+
+def export_ndjson(res_list, out, batch_size=EXPORT_BATCH_SIZE):
+    encode = json.JSONEncoder(separators=(',', ':')).encode
+    for batch in batched(flatten_results(res_list), batch_size):
+        out.write(''.join([encode(dict(zip(EXPORT_COLUMNS, r))) + '\n' for r in batch]))
+
+def _arrow_schema():
+    timestamp = pyarrow.timestamp('s')
+    return pyarrow.schema([
+        ('rrname', pyarrow.string()),
+        ('rrtype', pyarrow.string()),
+        ('bailiwick', pyarrow.string()),
+        ('rdata', pyarrow.string()),
+        ('count', pyarrow.int64()),
+        ('time_first', timestamp),
+        ('time_last', timestamp),
+        ('zone_time_first', timestamp),
+        ('zone_time_last', timestamp),
+    ])
+
+def _arrow_batch(batch, schema):
+    arrays = []
+    for field, column in zip(schema, zip(*batch)):
+        if field.type == pyarrow.string():
+            arrays.append(pyarrow.array(column, type=field.type))
+        else:
+            arrays.append(pyarrow.array(column, type=pyarrow.int64()).cast(field.type))
+    return pyarrow.RecordBatch.from_arrays(arrays, schema.names)
+
+def export_arrow(res_list, out, batch_size=EXPORT_BATCH_SIZE, parquet=False):
+    """
+    Write results as an Arrow IPC file, or as Parquet, one record batch
+    (or row group) per batch_size rows.
+    """
+    schema = _arrow_schema()
+    if parquet:
+        writer = pyarrow.parquet.ParquetWriter(out, schema)
+        write = lambda rb: writer.write_table(pyarrow.Table.from_batches([rb]))
+    else:
+        writer = pyarrow.RecordBatchFileWriter(out, schema)
+        write = writer.write_batch
+    try:
+        for batch in batched(flatten_results(res_list), batch_size):
+            write(_arrow_batch(batch, schema))
+    finally:
+        writer.close()
+
+def export_results(res_list, fmt, out):
+    if fmt == 'csv':
+        export_csv(res_list, out)
+    elif fmt == 'ndjson':
+        export_ndjson(res_list, out)
+    elif fmt in ('parquet', 'arrow'):
+        export_arrow(res_list, out, parquet=(fmt == 'parquet'))
+    else:
+        raise ValueError('Invalid export format: "%s"' % fmt)
+
+def time_output(res_list, run):
+    """
+    Pass results through, adding the time the consumer spends formatting
+    and writing each one to run['output'] and counting them in
+    run['records'].
+    """
+    for res in res_list:
+        start = time.time()
+        yield res
+        run['output'] += time.time() - start
+        run['records'] += 1
+
+def write_results(res_list, fmt_func, out=sys.stdout):
+    for res in res_list:
+        out.write('%s\n' % fmt_func(res))
+        # Flush per record so output reaches a pipe (e.g. tee in
+        # dnsdb-fetch.sh) as soon as the server sends it.
+        out.flush()
+
+def bulk_records(results):
+    """Unwrap bulk_query() results, reporting failed queries on stderr."""
+    for query, res, err in results:
+        if err is not None:
+            sys.stderr.write('dnsdb_query: %s: %s\n' % (query[0], err))
+            continue
+        yield res
+
+def write_bulk_results(results, as_json=False, out=sys.stdout):
+    for query, res, err in results:
+        label, method, args, fmt_func = query
+        if err is not None:
+            sys.stderr.write('dnsdb_query: %s: %s\n' % (label, err))
+            continue
+        if as_json:
+            out.write('%s\n' % result_to_json(dict(res, query=label)))
+        else:
+            out.write(';; query: %s\n%s\n' % (label, fmt_func(res)))
+        out.flush()
 
 def main():
     global cfg
@@ -205,60 +1732,357 @@ def main():
         help='output in JSON format')
     parser.add_option('-l', '--limit', dest='limit', type='int', default=0,
         help='limit number of results')
+    parser.add_option('-a', '--aggregate', dest='aggregate', action='store_true', default=False,
+        help='merge results of all queries given (any of -r, -n, -i, or --file) per rdata value')
+    parser.add_option('', '--top', dest='top', type='int',
+        help='only output the first TOP results (the top TOP with --sort)')
+    parser.add_option('', '--compact', dest='compact', action='store_true', default=False,
+        help='hold results in a compact form, to use less memory when sorting large result sets')
+    parser.add_option('', '--sort-buffer', dest='sort_buffer', type='int', default=DEFAULT_SORT_BUFFER,
+        help='results to sort in memory before spilling to disk (default: %d)' % DEFAULT_SORT_BUFFER)
+
+    parser.add_option('', '--paginate', dest='paginate', action='store_true', default=False,
+        help='fetch all results in pages of LIMIT results (default: %d), resuming an interrupted pull' % DEFAULT_PAGE_SIZE)
+    parser.add_option('-o', '--output', dest='output', type='string',
+        help='write results to OUTPUT; with --paginate, progress is kept in OUTPUT.checkpoint')
+    parser.add_option('-x', '--export', dest='export', type='choice', choices=EXPORT_FORMATS,
+        help='export results one row per rdata value, as %s' % ', '.join(EXPORT_FORMATS))
+    parser.add_option('', '--retries', dest='retries', type='int', default=3,
+        help='number of times to retry a failed page (default: 3)')
+    parser.add_option('', '--slice', dest='slice', action='store_true', default=False,
+        help='if a query returns LIMIT results (default: %d), split it into time windows fetched concurrently (see --threads) to get all results' % DEFAULT_PAGE_SIZE)
+    parser.add_option('', '--server-limit', dest='server_limit', type='int',
+        help='the most results the server returns for one query, if lower than LIMIT; with --slice, windows returning this many are split (default: SERVER_LIMIT in the config file)')
+
+    parser.add_option('-f', '--file', dest='bulk_file', type='string',
+        help='bulk lookup of names/IPs read from FILE, one per line ("-" for stdin)')
+    parser.add_option('', '--bulk-type', dest='bulk_type', type='choice',
+        choices=('auto', 'rrset', 'rdataname', 'rdataip'), default='auto',
+        help='lookup type for bulk queries: auto, rrset, rdataname or rdataip (default: auto)')
+    parser.add_option('-t', '--threads', dest='threads', type='int', default=8,
+        help='number of concurrent bulk queries (default: 8)')
+    parser.add_option('', '--rate', dest='rate', type='float', default=0,
+        help='maximum bulk queries per second (default: unlimited)')
+
+    parser.add_option('', '--no-cache', dest='no_cache', action='store_true', default=False,
+        help='do not use the local result cache')
+    parser.add_option('', '--refresh', dest='refresh', action='store_true', default=False,
+        help='ignore cached results and refresh them from the server')
+    parser.add_option('', '--cache-ttl', dest='cache_ttl', type='int',
+        help='seconds to keep new results in the cache (default: %d)' % DEFAULT_CACHE_TTL)
+    parser.add_option('', '--cache-stats', dest='cache_stats', action='store_true', default=False,
+        help='print result cache statistics to stderr')
+    parser.add_option('', '--stats', dest='stats', action='store_true', default=False,
+        help='write per-query timing and throughput statistics to stderr as JSON lines')
+    parser.add_option('', '--stats-file', dest='stats_file', type='string',
+        help='append --stats output to STATS_FILE instead of stderr (implies --stats)')
+
+    parser.add_option('-p', '--pivot', dest='pivot', type='string', action='append',
+        help='expand a graph of related names and IPs from SEED, output as JSON nodes and edges; may be repeated')
+    parser.add_option('', '--depth', dest='depth', type='int', default=2,
+        help='number of pivot levels to expand (default: 2)')
+    parser.add_option('', '--budget', dest='budget', type='int', default=100,
+        help='maximum number of pivot lookups (default: 100)')
+
+    parser.add_option('', '--store', dest='store', type='string',
+        help='query the local passive DNS store in STORE instead of the DNSDB API')
+    parser.add_option('', '--ingest', dest='ingest', type='string', action='append',
+        help='add saved dnsdb_query.py output (text or JSON, optionally gzip or zstd compressed) in FILE to --store; may be repeated ("-" for stdin)')
+
+    parser.add_option('', '--extract', dest='extract', type='string', action='append',
+        help='write the unique FQDNs and IPs of A/AAAA records in saved output FILE to FILE-fqdns.txt and FILE-ips.txt; may be repeated')
+    parser.add_option('', '--archive', dest='archive', type='string',
+        help='also write results as received to ARCHIVE as NDJSON, compressed if ARCHIVE ends in .gz (gzip) or .zst (zstd)')
+    parser.add_option('', '--read', dest='read', type='string', action='append',
+        help='read results from saved output or an --archive in FILE instead of querying; may be repeated ("-" for stdin)')
 
     parser.add_option('', '--before', dest='before', type='string', help='only output results seen before this time')
     parser.add_option('', '--after', dest='after', type='string', help='only output results seen after this time')
+    parser.add_option('', '--strict-before', dest='strict_before', type='string', help='only output results last seen before this time')
+    parser.add_option('', '--strict-after', dest='strict_after', type='string', help='only output results first seen after this time')
 
     options, args = parser.parse_args()
     if args:
         parser.print_help()
         sys.exit(1)
+    if options.sort and options.sort not in RECORD_FIELDS:
+        sys.stderr.write('dnsdb_query: invalid sort key "%s". valid sort keys are %s\n'
+            % (options.sort, ', '.join(sorted(RECORD_FIELDS))))
+        sys.exit(1)
+
+    if options.extract:
+        for fname in options.extract:
+            try:
+                outputs = extract_to_files(fname)
+            except (IOError, ValueError), e:
+                sys.stderr.write('dnsdb_query: %s: %s\n' % (fname, e))
+                sys.exit(1)
+            for out_fname, n in outputs:
+                sys.stdout.write('[*] %4d %s\n' % (n, out_fname))
+        return
+
+    if options.ingest:
+        if not options.store:
+            sys.stderr.write('dnsdb_query: --ingest requires --store\n')
+            sys.exit(1)
+        store = LocalStore(options.store)
+        for fname in options.ingest:
+            try:
+                n = store.ingest(read_results_file(fname))
+            except InputError, e:
+                sys.stderr.write('dnsdb_query: %s\n' % e)
+                sys.exit(1)
+            sys.stderr.write('dnsdb_query: %s: %s records\n' % (fname, locale.format('%d', n, True)))
+        return
+
+    # The local store and saved results need no API access or config.
+    read_only = options.read and not (options.rrset or options.rdata_name or
+        options.rdata_ip or options.bulk_file or options.pivot)
+    if options.store or read_only:
+        cfg = {}
+        options.no_cache = True
+    else:
+        try:
+            cfg = parse_config(options.config)
+        except IOError, e:
+            sys.stderr.write(e.message)
+            sys.exit(1)
 
+        if not 'DNSDB_SERVER' in cfg:
+            cfg['DNSDB_SERVER'] = DEFAULT_DNSDB_SERVER
+        if not 'APIKEY' in cfg:
+            sys.stderr.write('dnsdb_query: APIKEY not defined in config file\n')
+            sys.exit(1)
+
+    def open_cache():
+        if options.no_cache:
+            return None
+        ttl = options.cache_ttl
+        if ttl is None:
+            ttl = int(cfg.get('CACHE_TTL', DEFAULT_CACHE_TTL))
+        return ResultCache(cfg.get('CACHE_FILE', DEFAULT_CACHE_FILE), ttl,
+            int(cfg.get('CACHE_MAX_SIZE', DEFAULT_CACHE_MAX_SIZE)),
+            int(cfg.get('CACHE_MAX_ENTRY_SIZE', DEFAULT_CACHE_MAX_ENTRY_SIZE)))
+
+    def print_cache_stats(cache):
+        if cache is None or not options.cache_stats:
+            return
+        st = cache.stats()
+        sys.stderr.write('dnsdb_query: cache: %d entries, %s bytes, %d hits, %d misses\n' % (
+            st['entries'], locale.format('%d', st['size'], True), st['hits'], st['misses']))
+
+    # --before/--after and their strict variants are sent to the server as
+    # time fences; the client-side filters still run over what comes back.
+    fences = {}
     try:
-        cfg = parse_config(options.config)
-    except IOError, e:
-        sys.stderr.write(e.message)
+        if options.before:
+            fences['time_first_before'] = time_parse(options.before)
+        if options.after:
+            fences['time_last_after'] = time_parse(options.after)
+        if options.strict_before:
+            fences['time_last_before'] = time_parse(options.strict_before)
+        if options.strict_after:
+            fences['time_first_after'] = time_parse(options.strict_after)
+    except ValueError, e:
+        sys.stderr.write('dnsdb_query: %s\n' % e)
         sys.exit(1)
 
+    def filter_results(res_list):
+        if options.before:
+            res_list = filter_before(res_list, options.before)
+        if options.after:
+            res_list = filter_after(res_list, options.after)
+        if options.strict_before:
+            res_list = filter_strict_before(res_list, options.strict_before)
+        if options.strict_after:
+            res_list = filter_strict_after(res_list, options.strict_after)
+        return res_list
 
-    if not 'DNSDB_SERVER' in cfg:
-        cfg['DNSDB_SERVER'] = DEFAULT_DNSDB_SERVER
-    if not 'APIKEY' in cfg:
-        sys.stderr.write('dnsdb_query: APIKEY not defined in config file\n')
-        sys.exit(1)
+    if options.export:
+        if (options.bulk_file and not options.aggregate) or options.pivot or options.paginate:
+            sys.stderr.write('dnsdb_query: --export cannot be used with --pivot, --paginate or --file (unless aggregating)\n')
+            sys.exit(1)
+        if options.export in ('parquet', 'arrow'):
+            if not ARROW_MODULE:
+                sys.stderr.write('dnsdb_query: --export %s requires the pyarrow module\n' % options.export)
+                sys.exit(1)
+            if not options.output:
+                sys.stderr.write('dnsdb_query: --export %s requires --output\n' % options.export)
+                sys.exit(1)
+    if options.archive or options.read:
+        if (options.bulk_file and not options.aggregate) or options.pivot or options.paginate or options.slice:
+            sys.stderr.write('dnsdb_query: --archive and --read cannot be used with --pivot, --paginate, --slice or --file (unless aggregating)\n')
+            sys.exit(1)
 
-    client = DnsdbClient(cfg['DNSDB_SERVER'], cfg['APIKEY'], options.limit)
-    if options.rrset:
-        res_list = client.query_rrset(*options.rrset.split('/'))
+    stats = None
+    if options.stats_file:
+        stats = StatsWriter(open(options.stats_file, 'a'))
+    elif options.stats:
+        stats = StatsWriter(sys.stderr)
+
+    if options.store:
+        client_factory = lambda: LocalStore(options.store, options.limit)
+    else:
+        client_factory = lambda: DnsdbClient(cfg['DNSDB_SERVER'], cfg['APIKEY'],
+            options.limit, keepalive=True, cache=open_cache(), refresh=options.refresh,
+            stats=stats, compact=options.compact)
+
+    if options.pivot:
+        write_results(pivot(client_factory, options.pivot, options.depth,
+            options.budget, max(options.threads, 1), options.rate, fences), json.dumps)
+        return
+
+    if options.bulk_file:
+        if options.sort and not options.aggregate:
+            sys.stderr.write('dnsdb_query: --sort is not supported with --file unless aggregating\n')
+            sys.exit(1)
+        if options.paginate:
+            sys.stderr.write('dnsdb_query: --paginate is not supported with --file\n')
+            sys.exit(1)
+        if options.bulk_file == '-':
+            fp = sys.stdin
+        else:
+            fp = open(options.bulk_file)
+        results = bulk_query(client_factory,
+            read_bulk_queries(fp, options.bulk_type),
+            max(options.threads, 1), options.rate, fences, filter_results)
+        if not options.aggregate:
+            write_bulk_results(results, options.json)
+            print_cache_stats(open_cache())
+            return
+        cache = open_cache()
+        queries = [(lambda **kw: bulk_records(results), rrset_to_text)]
+    else:
+        if options.paginate:
+            if not options.output:
+                sys.stderr.write('dnsdb_query: --paginate requires --output\n')
+                sys.exit(1)
+            if options.sort or options.aggregate:
+                sys.stderr.write('dnsdb_query: --sort and --aggregate are not supported with --paginate\n')
+                sys.exit(1)
+            if not options.limit:
+                options.limit = DEFAULT_PAGE_SIZE
+        if options.slice:
+            if options.paginate:
+                sys.stderr.write('dnsdb_query: --slice cannot be used with --paginate\n')
+                sys.exit(1)
+            if not options.limit:
+                options.limit = DEFAULT_PAGE_SIZE
+
+        cache = open_cache()
+        if options.store:
+            client = LocalStore(options.store, options.limit)
+        elif not read_only:
+            # The keep-alive transport opens its own connections, which
+            # lets --stats break out DNS, connect and TLS time.
+            client = DnsdbClient(cfg['DNSDB_SERVER'], cfg['APIKEY'], options.limit,
+                keepalive=stats is not None, cache=cache, refresh=options.refresh,
+                stats=stats, compact=options.compact)
+
+        queries = []
+        if options.rrset:
+            queries.append((lambda **kw: client.query_rrset(*options.rrset.split('/'), **kw),
+                rrset_to_text))
+        if options.rdata_name:
+            queries.append((lambda **kw: client.query_rdata_name(*options.rdata_name.split('/'), **kw),
+                rdata_to_text))
+        if options.rdata_ip:
+            queries.append((lambda **kw: client.query_rdata_ip(options.rdata_ip, **kw),
+                rdata_to_text))
+        if options.read:
+            # Time fences are left to the client-side filters.
+            queries.append((lambda **kw: itertools.chain.from_iterable(
+                read_results_file(fname) for fname in options.read), result_to_text))
+        if not queries:
+            parser.print_help()
+            sys.exit(1)
+
+        if options.slice:
+            server_limit = options.server_limit or int(cfg.get('SERVER_LIMIT', 0))
+            def sliced(query, bulk_type):
+                label, method, args, fmt_func = parse_bulk_query(query, bulk_type)
+                query_func = lambda client, **kw: getattr(client, method)(*args, **kw)
+                return (lambda **kw: sliced_query(client_factory, query_func, options.limit,
+                    max(options.threads, 1), options.rate, kw, server_limit), fmt_func)
+            queries = []
+            for query, bulk_type in ((options.rrset, 'rrset'),
+                    (options.rdata_name, 'rdataname'), (options.rdata_ip, 'rdataip')):
+                if query:
+                    queries.append(sliced(query, bulk_type))
+
+    if options.aggregate:
+        query_func = lambda **kw: aggregate_results(itertools.chain(*[q(**kw) for q, f in queries]))
         fmt_func = rrset_to_text
-    elif options.rdata_name:
-        res_list = client.query_rdata_name(*options.rdata_name.split('/'))
-        fmt_func = rdata_to_text
-    elif options.rdata_ip:
-        res_list = client.query_rdata_ip(options.rdata_ip)
-        fmt_func = rdata_to_text
     else:
-        parser.print_help()
-        sys.exit(1)
+        query_func, fmt_func = queries[0]
 
     if options.json:
-        fmt_func = json.dumps
+        fmt_func = result_to_json
+
+    if options.paginate:
+        query = {'rrset': options.rrset, 'rdata_name': options.rdata_name,
+            'rdata_ip': options.rdata_ip, 'json': options.json,
+            'page_size': options.limit, 'fences': fences}
+        try:
+            n = paged_query_to_file(lambda **kw: query_func(**dict(fences, **kw)),
+                query, options.output, fmt_func, filter_results, options.limit,
+                options.retries)
+        except QueryError, e:
+            sys.stderr.write('dnsdb_query: %s\n' % e)
+            sys.exit(1)
+        sys.stderr.write('dnsdb_query: %s: %s results\n' % (options.output, locale.format('%d', n, True)))
+        print_cache_stats(cache)
+        return
+
+    # Results are streamed from the server through lazy filter and sort
+    # stages, so memory use does not grow with the size of the result set.
+    res_list = query_func(**fences)
+
+    archive = None
+    if options.archive:
+        try:
+            archive = ResultArchive(options.archive)
+        except IOError, e:
+            sys.stderr.write('dnsdb_query: %s\n' % e)
+            sys.exit(1)
+        res_list = archive_results(res_list, archive)
+    res_list = filter_results(res_list)
 
-    if len(res_list) > 0:
+    run = {'type': 'run', 'start': time.time(), 'output': 0.0, 'records': 0}
+    try:
         if options.sort:
-            if not options.sort in res_list[0]:
-                sort_keys = res_list[0].keys()
-                sort_keys.sort()
-                sys.stderr.write('dnsdb_query: invalid sort key "%s". valid sort keys are %s\n' % (options.sort, ', '.join(sort_keys)))
-                sys.exit(1)
-            res_list.sort(key=lambda r: r[options.sort], reverse=options.reverse)
-        if options.before:
-            res_list = filter_before(res_list, options.before)
-        if options.after:
-            res_list = filter_after(res_list, options.after)
+            res_list = sort_results(res_list, options.sort, options.reverse,
+                options.top, max(options.sort_buffer, 1))
+        elif options.top is not None:
+            res_list = itertools.islice(res_list, options.top)
 
-    for res in res_list:
-        sys.stdout.write('%s\n' % fmt_func(res))
+        if options.output:
+            out = open(options.output, 'wb')
+        else:
+            out = sys.stdout
+        if stats is not None:
+            res_list = time_output(res_list, run)
+        if options.export:
+            export_results(res_list, options.export, out)
+        else:
+            write_results(res_list, fmt_func, out)
+        if out is not sys.stdout:
+            out.close()
+    except (QueryError, IOError, zlib.error), e:
+        sys.stderr.write(str(e) + '\n')
+        sys.exit(1)
+    except InputError, e:
+        sys.stderr.write('dnsdb_query: %s\n' % e)
+        sys.exit(1)
+    finally:
+        if archive is not None:
+            archive.close()
+
+    if stats is not None:
+        run['elapsed'] = time.time() - run.pop('start')
+        run['records_per_sec'] = run['records'] / run['elapsed'] if run['elapsed'] else 0.0
+        stats(run)
+    print_cache_stats(cache)
 
 if __name__ == '__main__':
     main()
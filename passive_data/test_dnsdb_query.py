@@ -0,0 +1,79 @@
+#!/usr/bin/env python2
+
+# Tests for dnsdb_query.py. Run with: python2 -m unittest test_dnsdb_query
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import dnsdb_query
+
+
+class AggregateResultsTest(unittest.TestCase):
+    rrset = {'rrname': 'www.example.com.', 'rrtype': 'A', 'bailiwick': 'example.com.',
+             'rdata': ['10.0.0.1', '10.0.0.2'], 'count': 5,
+             'time_first': 1000, 'time_last': 2000}
+    rdata = {'rrname': 'www.example.com.', 'rrtype': 'A', 'rdata': '10.0.0.1',
+             'count': 3, 'time_first': 500, 'time_last': 2500}
+
+    def aggregate(self, res_list):
+        return dict((res['rdata'][0], res) for res in dnsdb_query.aggregate_results(res_list))
+
+    def test_merges_rdata_result_into_rrset_result(self):
+        for res_list in ([self.rrset, self.rdata], [self.rdata, self.rrset]):
+            merged = self.aggregate(res_list)
+            self.assertEqual(len(merged), 2)
+            self.assertEqual(merged['10.0.0.1'], {
+                'rrname': 'www.example.com.', 'rrtype': 'A', 'bailiwick': 'example.com.',
+                'rdata': ['10.0.0.1'], 'count': 8, 'time_first': 500, 'time_last': 2500})
+            self.assertEqual(merged['10.0.0.2']['count'], 5)
+
+    def test_rdata_results_alone(self):
+        merged = self.aggregate([self.rdata, self.rdata])
+        self.assertEqual(merged['10.0.0.1']['count'], 6)
+        self.assertNotIn('bailiwick', merged['10.0.0.1'])
+
+    def test_ambiguous_bailiwick_not_merged(self):
+        other = dict(self.rrset, bailiwick='com.')
+        results = list(dnsdb_query.aggregate_results([self.rrset, other, self.rdata]))
+        self.assertEqual(len([res for res in results if res['rdata'] == ['10.0.0.1']]), 3)
+
+
+class SortResultsTest(unittest.TestCase):
+    results = [{'rrname': 'a.', 'zone_time_first': 30}, {'rrname': 'b.'},
+               {'rrname': 'c.', 'zone_time_first': 10}, {'rrname': 'd.'},
+               {'rrname': 'e.', 'zone_time_first': 20}]
+
+    def names(self, **kw):
+        return [res['rrname'] for res in
+                dnsdb_query.sort_results(iter(self.results), 'zone_time_first', **kw)]
+
+    def test_missing_key_sorts_last(self):
+        for buffer_size in (100, 2):
+            self.assertEqual(self.names(buffer_size=buffer_size), ['c.', 'e.', 'a.', 'b.', 'd.'])
+            self.assertEqual(self.names(reverse=True, buffer_size=buffer_size),
+                             ['a.', 'e.', 'c.', 'b.', 'd.'])
+        self.assertEqual(self.names(top=4), ['c.', 'e.', 'a.', 'b.'])
+        self.assertEqual(self.names(reverse=True, top=4), ['a.', 'e.', 'c.', 'b.'])
+
+
+class ResultCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_entry_size_limit(self):
+        cache = dnsdb_query.ResultCache(os.path.join(self.tmpdir, 'cache'), max_entry_size=1000)
+        small = '{"rrname": "a."}'
+        large = os.urandom(2000)
+        cache.put('small', small)
+        cache.put('large', large)
+        self.assertEqual(cache.get('small'), small)
+        self.assertEqual(cache.get('large'), None)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,438 @@
+#!/usr/bin/env python2
+
+# Copyright (c) 2026 Darren Spruell <phatbuckett@gmail.com>
+#
+# Permission to use, copy, modify, and distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+# Benchmark file-info.py analysis stages on a synthetic corpus.
+#
+# Builds a corpus of random blobs, PE32 and PE32+ files with many sections
+# and imports, and a few large files, along with a PEiD signature database.
+# Reports files/sec for each stage (hashing by file class, PE parsing,
+# signature index compile/load/match, MHR lookups against a local
+# mhr-stub-dns.py and whole FileInfo analysis) and peak RSS. Results can
+# be saved as JSON (-j) and compared against a saved baseline (-b),
+# exiting non-zero when a stage is slower than the baseline by more than
+# the tolerance.
+
+import imp
+import json
+import optparse
+import os
+import random
+import resource
+import shutil
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+
+BASEDIR = os.path.dirname(os.path.abspath(__file__))
+file_info = imp.load_source('file_info', os.path.join(BASEDIR, 'file-info.py'))
+
+MHR_STUB = os.path.join(BASEDIR, 'mhr-stub-dns.py')
+
+# Entry point code of the generated PE files, matched by BENCH_SIGNATURE
+EP_CODE = '\x60\xbe\x00\x10\x40\x00\x8d\xbe\x00\x00\xff\xff\x57\x83\xcd\xff'
+BENCH_SIGNATURE = 'Bench packer'
+# Common entry point prefixes, so the generated signatures share trie nodes
+# as real databases do
+SIGNATURE_PREFIXES = ['60', '55 8B EC', 'E8 ?? ?? ?? ??', 'EB', '53 56 57']
+
+FILE_ALIGNMENT = 0x200
+SECTION_ALIGNMENT = 0x1000
+
+
+def peak_rss():
+    "Peak resident set size of this process so far, in KB"
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def align(n, alignment):
+    return (n + alignment - 1) // alignment * alignment
+
+
+def random_bytes(rand, size, entropy=8):
+    "size random bytes, drawn from 2 ** entropy values"
+    if size <= 0:
+        return ''
+    if entropy >= 8:
+        return ('%0*x' % (size * 2, rand.getrandbits(size * 8))).decode('hex')
+    alphabet = [chr(rand.randrange(256)) for i in xrange(2 ** entropy)]
+    return ''.join(rand.choice(alphabet) for i in xrange(size))
+
+
+def build_imports(rva, plus, dlls):
+    """
+    Build an import directory at rva for dlls, a list of (name, function
+    names). Return the data, the import directory size and the import
+    address table offset and size.
+    """
+    thunk_fmt = '<Q' if plus else '<I'
+    thunk_size = struct.calcsize(thunk_fmt)
+    desc_size = 20 * (len(dlls) + 1)
+    thunks_size = sum(len(funcs) + 1 for name, funcs in dlls) * thunk_size
+    ilt_offset = desc_size
+    iat_offset = ilt_offset + thunks_size
+    names_offset = iat_offset + thunks_size
+
+    descriptors = []
+    thunks = []
+    names = []
+    names_size = 0
+    for dll, funcs in dlls:
+        first_thunk = len(thunks) * thunk_size
+        for func in funcs:
+            thunks.append(rva + names_offset + names_size)
+            entry = struct.pack('<H', 0) + func + '\0'
+            entry += '\0' * (len(entry) % 2)
+            names.append(entry)
+            names_size += len(entry)
+        thunks.append(0)
+        descriptors.append(struct.pack('<IIIII', rva + ilt_offset + first_thunk, 0, 0,
+                                       rva + names_offset + names_size,
+                                       rva + iat_offset + first_thunk))
+        names.append(dll + '\0')
+        names_size += len(dll) + 1
+    descriptors.append('\0' * 20)
+
+    thunk_data = ''.join(struct.pack(thunk_fmt, t) for t in thunks)
+    data = ''.join(descriptors) + thunk_data + thunk_data + ''.join(names)
+    return data, desc_size, iat_offset, thunks_size
+
+
+def build_pe(rand, plus, nsections, ndlls, nfuncs, overlay=0):
+    """
+    Build a minimal valid PE32 (or PE32+ with plus) image with a code
+    section, an import section and nsections data sections of varying
+    entropy, importing nfuncs functions from each of ndlls DLLs. Return the
+    file data and the file offset of the entry point.
+    """
+    dlls = [('bench%d.dll' % d, ['Function%d_%d' % (d, f) for f in xrange(nfuncs)])
+            for d in xrange(ndlls)]
+    opt_size = 240 if plus else 224
+    headers_size = align(0x40 + 4 + 20 + opt_size + 40 * (nsections + 2), FILE_ALIGNMENT)
+
+    text = EP_CODE + random_bytes(rand, 0x1000 - len(EP_CODE))
+    text_rva = SECTION_ALIGNMENT
+    idata_rva = text_rva + align(len(text), SECTION_ALIGNMENT)
+    idata, import_size, iat_offset, iat_size = build_imports(idata_rva, plus, dlls)
+    sections = [('.text', text_rva, text, 0x60000020), ('.idata', idata_rva, idata, 0xc0000040)]
+    rva = idata_rva + align(len(idata), SECTION_ALIGNMENT)
+    for i in xrange(nsections):
+        data = random_bytes(rand, rand.choice([0x200, 0x1000, 0x4000]), rand.choice([1, 4, 8]))
+        sections.append(('.d%d' % i, rva, data, 0x40000040))
+        rva += align(len(data), SECTION_ALIGNMENT)
+    size_of_image = rva
+
+    directories = [(0, 0)] * 16
+    directories[1] = (idata_rva, import_size)
+    directories[12] = (idata_rva + iat_offset, iat_size)
+    if plus:
+        optional = struct.pack('<HBBIIIIIQIIHHHHHHIIIIHHQQQQII', 0x20b, 14, 0,
+            len(text), size_of_image - SECTION_ALIGNMENT - len(text), 0, text_rva, text_rva,
+            0x140000000, SECTION_ALIGNMENT, FILE_ALIGNMENT, 6, 0, 0, 0, 6, 0, 0,
+            size_of_image, headers_size, 0, 3, 0, 0x100000, 0x1000, 0x100000, 0x1000, 0, 16)
+    else:
+        optional = struct.pack('<HBBIIIIIIIIIHHHHHHIIIIHHIIIIII', 0x10b, 14, 0,
+            len(text), size_of_image - SECTION_ALIGNMENT - len(text), 0, text_rva, text_rva,
+            idata_rva, 0x400000, SECTION_ALIGNMENT, FILE_ALIGNMENT, 6, 0, 0, 0, 6, 0, 0,
+            size_of_image, headers_size, 0, 3, 0, 0x100000, 0x1000, 0x100000, 0x1000, 0, 16)
+    optional += ''.join(struct.pack('<II', *d) for d in directories)
+
+    headers = ['MZ', '\0' * 0x3a, struct.pack('<I', 0x40), 'PE\0\0',
+               struct.pack('<HHIIIHH', 0x8664 if plus else 0x14c, len(sections),
+                           rand.randint(0x40000000, 0x60000000), 0, 0, opt_size,
+                           0x22 if plus else 0x102),
+               optional]
+    body = []
+    offset = headers_size
+    for name, rva, data, characteristics in sections:
+        raw_size = align(len(data), FILE_ALIGNMENT)
+        headers.append(struct.pack('<8sIIIIIIHHI', name, len(data), rva, raw_size, offset,
+                                   0, 0, 0, 0, characteristics))
+        body.append(data + '\0' * (raw_size - len(data)))
+        offset += raw_size
+    headers = ''.join(headers)
+    headers += '\0' * (headers_size - len(headers))
+    return headers + ''.join(body) + random_bytes(rand, overlay), headers_size
+
+
+def build_signatures(fname, rand, count):
+    "Write a PEiD database of count random signatures plus BENCH_SIGNATURE"
+    with open(fname, 'w') as f:
+        for i in xrange(count):
+            tokens = rand.choice(SIGNATURE_PREFIXES).split()
+            for j in xrange(rand.randint(4, 40)):
+                tokens.append('??' if rand.random() < 0.15 else '%02X' % rand.randrange(256))
+            f.write('[Signature %d]\nsignature = %s\nep_only = %s\n\n' %
+                    (i, ' '.join(tokens), 'true' if rand.random() < 0.9 else 'false'))
+        f.write('[%s]\nsignature = %s\nep_only = true\n\n' %
+                (BENCH_SIGNATURE, ' '.join('%02X' % ord(c) for c in EP_CODE)))
+
+
+def build_corpus(dirname, options):
+    """
+    Write the benchmark corpus to dirname. Return the paths of each class
+    of file, the entry point offset of each PE file and the path of the
+    signature database.
+    """
+    rand = random.Random(options.seed)
+    corpus = {'blob': [], 'pe': [], 'large': []}
+    entry_points = {}
+
+    for i in xrange(options.blobs):
+        path = os.path.join(dirname, 'blob%05d' % i)
+        # Sizes spread evenly on a log scale from 1 KB to 1 MB
+        with open(path, 'wb') as f:
+            f.write(random_bytes(rand, int(1024 * 2 ** rand.uniform(0, 10))))
+        corpus['blob'].append(path)
+
+    for i in xrange(options.pe):
+        path = os.path.join(dirname, 'pe%05d.exe' % i)
+        overlay = rand.choice([0, 0, 0x1000])
+        data, ep = build_pe(rand, i % 2 == 1, options.sections, options.dlls, options.functions, overlay)
+        with open(path, 'wb') as f:
+            f.write(data)
+        corpus['pe'].append(path)
+        entry_points[path] = ep
+
+    block = random_bytes(rand, 1024 * 1024)
+    for i in xrange(options.large):
+        path = os.path.join(dirname, 'large%02d' % i)
+        with open(path, 'wb') as f:
+            for j in xrange(options.large_size):
+                f.write(block)
+        corpus['large'].append(path)
+
+    pedb = os.path.join(dirname, 'userdb.txt')
+    build_signatures(pedb, rand, options.signatures)
+    return corpus, entry_points, pedb
+
+
+def start_stub():
+    proc = subprocess.Popen([sys.executable, MHR_STUB, '-p', '0', '-r', '0.2'], stdout=subprocess.PIPE)
+    server = proc.stdout.readline().strip()
+    if not server:
+        proc.wait()
+        sys.exit('file-info-bench: MHR stub server failed to start')
+    return proc, server
+
+
+def timed(func, repeat):
+    "Run func repeat times; return the fastest run as (seconds, result)"
+    best = None
+    for i in range(repeat):
+        start = time.time()
+        res = func()
+        elapsed = time.time() - start
+        if best is None or elapsed < best[0]:
+            best = (elapsed, res)
+    return best
+
+
+def hash_files(paths):
+    for path in paths:
+        file_info.hash_data(file_info.map_file(path))
+    return len(paths)
+
+
+def parse_pe_files(paths, verbose=False):
+    for path in paths:
+        data = file_info.map_file(path)
+        pe = file_info.pefile.PE(data=data, fast_load=True)
+        if verbose:
+            pe.parse_data_directories()
+    return len(paths)
+
+
+def analyze_files(paths, verbose=False):
+    for path in paths:
+        info = file_info.FileInfo(path)
+        if verbose and info.is_pe:
+            info.parse_verbose_info()
+    return len(paths)
+
+
+def match_signatures(index, entry_data, loops):
+    for i in xrange(loops):
+        for data in entry_data:
+            if not index.match(data):
+                raise RuntimeError('benchmark signature did not match')
+    return loops * len(entry_data)
+
+
+def run_benchmarks(options, corpus, entry_points, pedb, mhr_server, workdir):
+    results = {}
+
+    def add(stage, seconds, n, nbytes=None):
+        results[stage] = dict(seconds=seconds, files=n, peak_rss_kb=peak_rss(),
+            files_per_sec=n / seconds if seconds else 0)
+        if nbytes is not None:
+            results[stage]['mb_per_sec'] = nbytes / seconds / 2 ** 20 if seconds else 0
+
+    def size(paths):
+        return sum(os.path.getsize(p) for p in paths)
+
+    all_files = corpus['blob'] + corpus['pe'] + corpus['large']
+
+    for kind in ('blob', 'pe', 'large'):
+        paths = corpus[kind]
+        if paths:
+            secs, n = timed(lambda: hash_files(paths), options.repeat)
+            add('hash_%s' % kind, secs, n, size(paths))
+
+    if file_info.PE_MODULE and corpus['pe']:
+        secs, n = timed(lambda: parse_pe_files(corpus['pe']), options.repeat)
+        add('pe_parse', secs, n, size(corpus['pe']))
+        secs, n = timed(lambda: parse_pe_files(corpus['pe'], True), options.repeat)
+        add('pe_parse_full', secs, n, size(corpus['pe']))
+
+    secs, index = timed(lambda: file_info.SignatureIndex.parse(pedb), options.repeat)
+    add('sig_compile', secs, 1)
+    st = os.stat(pedb)
+    key = (os.path.abspath(pedb), st.st_size, st.st_mtime)
+    index_file = os.path.join(workdir, 'userdb.sigidx')
+    index.save(index_file, key)
+    secs, index = timed(lambda: file_info.SignatureIndex.load(index_file, key), options.repeat)
+    add('sig_load', secs, 1)
+    # Matched many times over, as a single pass is too quick to time.
+    entry_data = []
+    for path in corpus['pe']:
+        with open(path, 'rb') as f:
+            f.seek(entry_points[path])
+            entry_data.append(f.read(index.depth))
+    if entry_data:
+        secs, n = timed(lambda: match_signatures(index, entry_data, 100), options.repeat)
+        add('sig_match', secs, n)
+
+    hashes = [file_info.hash_data(file_info.map_file(p))['md5'] for p in all_files]
+    rand = random.Random(options.seed)
+    hashes += ['%032x' % rand.getrandbits(128) for i in xrange(options.mhr_hashes)]
+    resolver = file_info.MHRResolver(mhr_server)
+    secs, n = timed(lambda: len(resolver.lookup(hashes)), options.repeat)
+    add('mhr_lookup', secs, n)
+
+    # FileInfo finds the signature index in its per-process cache.
+    os.environ['PEDBPATH'] = pedb
+    file_info.load_signature_index(pedb, index_file)
+    secs, n = timed(lambda: analyze_files(all_files), options.repeat)
+    add('fileinfo', secs, n, size(all_files))
+    if file_info.PE_MODULE and corpus['pe']:
+        secs, n = timed(lambda: analyze_files(corpus['pe'], True), options.repeat)
+        add('fileinfo_verbose_pe', secs, n, size(corpus['pe']))
+
+    results['peak_rss_kb'] = peak_rss()
+    return results
+
+
+def print_results(results, baseline=None):
+    print '%-20s %8s %10s %12s %10s %10s %10s' % ('stage', 'files', 'seconds', 'files/sec',
+        'MB/sec', 'RSS KB', 'change')
+    for stage in sorted(k for k in results if isinstance(results[k], dict)):
+        r = results[stage]
+        change = ''
+        if baseline and stage in baseline and baseline[stage]['files_per_sec']:
+            change = '%+.1f%%' % (100.0 * r['files_per_sec'] / baseline[stage]['files_per_sec'] - 100)
+        mb = '%10.1f' % r['mb_per_sec'] if 'mb_per_sec' in r else '%10s' % '-'
+        print '%-20s %8d %10.3f %12.1f %s %10d %10s' % (stage, r['files'], r['seconds'],
+            r['files_per_sec'], mb, r['peak_rss_kb'], change)
+    print 'peak RSS: %d KB' % results['peak_rss_kb']
+
+
+def regressions(results, baseline, tolerance):
+    slower = []
+    for stage, r in results.items():
+        if not isinstance(r, dict) or stage not in baseline:
+            continue
+        base = baseline[stage]['files_per_sec']
+        if base and r['files_per_sec'] < base * (1 - tolerance):
+            slower.append(stage)
+    return sorted(slower)
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('-n', '--blobs', dest='blobs', type='int', default=200,
+        help='number of random blobs, 1 KB to 1 MB (default: 200)')
+    parser.add_option('-p', '--pe', dest='pe', type='int', default=100,
+        help='number of PE files, half PE32 and half PE32+ (default: 100)')
+    parser.add_option('-S', '--sections', dest='sections', type='int', default=32,
+        help='data sections per PE file (default: 32)')
+    parser.add_option('-D', '--dlls', dest='dlls', type='int', default=8,
+        help='imported DLLs per PE file (default: 8)')
+    parser.add_option('-F', '--functions', dest='functions', type='int', default=64,
+        help='imported functions per DLL (default: 64)')
+    parser.add_option('-L', '--large', dest='large', type='int', default=2,
+        help='number of large files (default: 2)')
+    parser.add_option('-M', '--large-size', dest='large_size', type='int', default=64,
+        help='size of each large file in MB (default: 64)')
+    parser.add_option('-k', '--signatures', dest='signatures', type='int', default=4000,
+        help='number of PEiD signatures (default: 4000)')
+    parser.add_option('-m', '--mhr-hashes', dest='mhr_hashes', type='int', default=5000,
+        help='random hashes to look up besides the corpus files (default: 5000)')
+    parser.add_option('-s', '--seed', dest='seed', type='int', default=1,
+        help='random seed for the corpus (default: 1)')
+    parser.add_option('-d', '--dir', dest='dir',
+        help='build the corpus in this directory and keep it')
+    parser.add_option('-r', '--repeat', dest='repeat', type='int', default=3,
+        help='runs per stage; the fastest is reported (default: 3)')
+    parser.add_option('-j', '--json', dest='json',
+        help='write results as JSON to this file')
+    parser.add_option('-b', '--baseline', dest='baseline',
+        help='compare against results saved with -j')
+    parser.add_option('-t', '--tolerance', dest='tolerance', type='float', default=0.1,
+        help='fractional slowdown against the baseline to report as a regression (default: 0.1)')
+    options, args = parser.parse_args()
+    if args:
+        parser.print_help()
+        sys.exit(1)
+
+    workdir = options.dir or tempfile.mkdtemp(prefix='file-info-bench.')
+    if not os.path.isdir(workdir):
+        os.makedirs(workdir)
+    proc = None
+    try:
+        corpus, entry_points, pedb = build_corpus(workdir, options)
+        proc, mhr_server = start_stub()
+        results = run_benchmarks(options, corpus, entry_points, pedb, mhr_server, workdir)
+    finally:
+        if proc:
+            proc.terminate()
+            proc.wait()
+        if not options.dir:
+            shutil.rmtree(workdir)
+
+    baseline = None
+    if options.baseline:
+        with open(options.baseline) as fp:
+            baseline = json.load(fp)
+    print_results(results, baseline)
+
+    if options.json:
+        with open(options.json, 'w') as fp:
+            json.dump(results, fp, indent=2, sort_keys=True)
+
+    if baseline:
+        slower = regressions(results, baseline, options.tolerance)
+        if slower:
+            sys.stderr.write('file-info-bench: slower than baseline: %s\n' % ', '.join(slower))
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    try:
+        main()
+    except KeyboardInterrupt:
+        pass
@@ -19,24 +19,71 @@
 # Display useful information for analyzing files.
 #
 # Requires (for full functionality): 
-#    atklite  - basic file analysis, hashes, etc.
+#    python-magic - file type identification
+#    ssdeep   - fuzzy hashing
 #    pefile   - analysis of PE file structure and packer detection
-#    PyDNS    - DNS resolution for MHR lookup
 
+import collections
+import errno
+import functools
+import hashlib
+import json
+import marshal
+import math
+import mmap
+import multiprocessing
 import os
+import random
+import select
+import socket
+import sqlite3
+import struct
 import sys
 import time
+import zlib
 from os.path import basename
 from optparse import OptionParser
-try:
-    from cStringIO import StringIO
-except:
-    from StringIO import StringIO
 
-import atklite
+# Files are hashed in chunks of this many bytes
+HASH_CHUNK_SIZE = 1024 * 1024
+# Bytes from the start of the file given to libmagic for the file type
+MAGIC_BUFFER_SIZE = 1024 * 1024
+# Bump when a change alters analysis results, so cached results are dropped
+ANALYZER_VERSION = 5
+DEFAULT_CACHE_FILE = '~/.file-info.cache'
+# Compiled form of the PEiD signature database in PEDBPATH
+DEFAULT_SIGINDEX_FILE = '~/.file-info.sigidx'
+
+# Team Cymru Malware Hash Registry lookups
+MHR_ZONE = 'malware.hash.cymru.com'
+MHR_UNAVAILABLE = '[unavailable]'
+MHR_CONCURRENCY = 64
+MHR_TIMEOUT = 2.0
+MHR_RETRIES = 2
+MHR_POSITIVE_TTL = 86400
+MHR_NEGATIVE_TTL = 3600
+# Batch mode holds finished records for up to this many files or seconds to
+# look up their hashes together
+MHR_BATCH_SIZE = 500
+MHR_BATCH_WAIT = 1.0
+# Without -b, files are printed in groups of this many to look up their
+# hashes together
+MHR_PRINT_BATCH_SIZE = 32
 
 # Initialize errors list and do remaining imports
 errs = []
+try:
+    import magic
+    MAGIC_MODULE = True
+except ImportError:
+    errs.append("WARNING: Unable to load magic module. File type identification disabled.")
+    MAGIC_MODULE = False
+try:
+    import ssdeep
+    SSDEEP_MODULE = True
+except ImportError:
+    errs.append("WARNING: Unable to load ssdeep module. Fuzzy hashing disabled.")
+    SSDEEP_MODULE = False
 try:
     import pefile
     import peutils
@@ -45,11 +92,249 @@ except ImportError:
     errs.append("WARNING: Unable to load pefile module(s). PE analysis functionality disabled.")
     PE_MODULE = False
 try:
-    import DNS
-    DNS_MODULE = True
+    import numpy
+    NUMPY_MODULE = True
 except ImportError:
-    errs.append("WARNING: Cannot load python DNS module (required for MHR lookup).")
-    DNS_MODULE = False
+    errs.append("WARNING: Unable to load numpy module. Section entropy will be slower to compute.")
+    NUMPY_MODULE = False
+
+
+def map_file(filepath):
+    """
+    Return a read-only memory map of the file at filepath, or an empty
+    string for an empty file (which cannot be mapped).
+    """
+    with open(filepath, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return ''
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def hash_data(data, chunk_size=HASH_CHUNK_SIZE):
+    """
+    Compute CRC32, MD5, SHA1, SHA256 and ssdeep digests of data (a string
+    or memory map) in a single sequential pass, feeding each chunk to every
+    digest in turn.
+    """
+    crc32 = 0
+    md5 = hashlib.md5()
+    sha1 = hashlib.sha1()
+    sha256 = hashlib.sha256()
+    fuzzy = ssdeep.Hash() if SSDEEP_MODULE else None
+
+    for offset in xrange(0, len(data), chunk_size):
+        chunk = data[offset:offset + chunk_size]
+        crc32 = zlib.crc32(chunk, crc32)
+        md5.update(chunk)
+        sha1.update(chunk)
+        sha256.update(chunk)
+        if fuzzy is not None:
+            fuzzy.update(chunk)
+
+    return {
+        'crc32':  "%08x" % (crc32 & 0xffffffff),
+        'md5':    md5.hexdigest(),
+        'sha1':   sha1.hexdigest(),
+        'sha256': sha256.hexdigest(),
+        'ssdeep': fuzzy.digest() if fuzzy is not None else "[unavailable]",
+    }
+
+
+def byte_histogram(data, offset=0, size=None):
+    """
+    Count each byte value in size bytes of data (a string or memory map)
+    from offset, without copying them when numpy is available.
+    """
+    size = len(data) - offset if size is None else min(size, len(data) - offset)
+    if size <= 0:
+        return [0] * 256
+    if NUMPY_MODULE:
+        values = numpy.frombuffer(data, dtype=numpy.uint8, count=size, offset=offset)
+        return numpy.bincount(values, minlength=256).tolist()
+    chunk = data[offset:offset + size]
+    return [chunk.count(chr(i)) for i in xrange(256)]
+
+
+def shannon_entropy(histogram):
+    "Shannon entropy, in bits per byte, of the bytes counted in histogram"
+    total = float(sum(histogram))
+    if not total:
+        return 0.0
+    return 0.0 - sum(n / total * math.log(n / total, 2) for n in histogram if n)
+
+
+def entry_point_offset(pe):
+    "Return the file offset of the PE entry point, or None if it has none"
+    try:
+        return pe.get_offset_from_rva(pe.OPTIONAL_HEADER.AddressOfEntryPoint)
+    except pefile.PEFormatError:
+        return None
+
+
+def _pe_name(name):
+    "Decode a section, DLL or function name from a PE file, which may be any bytes"
+    if name is None:
+        return None
+    return name.decode('latin-1')
+
+
+def _signature_mask(token):
+    "Return (mask, value) for a signature token such as 'E8', '8?' or '??'"
+    if len(token) != 2:
+        raise ValueError(token)
+    mask = (0 if token[0] == '?' else 0xf0) | (0 if token[1] == '?' else 0x0f)
+    return mask, int(token.replace('?', '0'), 16)
+
+
+class SignatureIndex(object):
+    """
+    PEiD entry-point signatures compiled into a trie over the signature
+    bytes, so the bytes at a file's entry point are matched against every
+    signature in one walk. Each node is (children by byte value, masked
+    children as (mask, value, child) for wildcard tokens such as '8?' and
+    '??', names of the signatures ending there); nodes[0] is the root. A
+    byte b follows a masked edge when b & mask == value.
+
+    As with peutils, signatures without ep_only = true are not used and
+    the names of the longest matching signatures are returned.
+    """
+    MAGIC = 'FISIGIDX'
+    FORMAT = 2
+
+    def __init__(self, nodes, depth):
+        self.nodes = nodes
+        self.depth = depth
+
+    @classmethod
+    def parse(cls, fname):
+        "Compile the PEiD signature database (userdb.txt format) in fname"
+        nodes = [({}, [], [])]
+        depth = 0
+        entries = []
+        with open(fname) as f:
+            entry = None
+            for line in f:
+                line = line.strip()
+                if line.startswith('[') and line.endswith(']'):
+                    entry = {'name': line[1:-1]}
+                    entries.append(entry)
+                elif entry is not None and '=' in line:
+                    key, value = line.split('=', 1)
+                    entry[key.strip().lower()] = value.strip()
+
+        for entry in entries:
+            if entry.get('ep_only', '').lower() != 'true' or 'signature' not in entry:
+                continue
+            tokens = entry['signature'].upper().split()
+            # Trailing wildcards match anything, including the end of data.
+            while tokens and tokens[-1] == '??':
+                tokens.pop()
+            try:
+                values = [_signature_mask(t) for t in tokens]
+            except ValueError:
+                continue
+            if not values:
+                continue
+
+            n = 0
+            for mask, value in values:
+                children, masked, names = nodes[n]
+                if mask == 0xff:
+                    child = children.get(value)
+                    if child is None:
+                        child = children[value] = len(nodes)
+                        nodes.append(({}, [], []))
+                else:
+                    for edge_mask, edge_value, child in masked:
+                        if edge_mask == mask and edge_value == value:
+                            break
+                    else:
+                        child = len(nodes)
+                        masked.append((mask, value, child))
+                        nodes.append(({}, [], []))
+                n = child
+            if entry['name'] not in nodes[n][2]:
+                nodes[n][2].append(entry['name'])
+            depth = max(depth, len(values))
+
+        return cls([(children, tuple(masked), tuple(names)) for children, masked, names in nodes],
+                   depth)
+
+    @classmethod
+    def load(cls, fname, key):
+        "Load an index saved with key, or return None if there is no such index"
+        try:
+            with open(fname, 'rb') as f:
+                if f.read(len(cls.MAGIC)) != cls.MAGIC:
+                    return None
+                fmt, saved_key, depth, nodes = marshal.load(f)
+        except (IOError, EOFError, ValueError, TypeError):
+            return None
+        if fmt != cls.FORMAT or saved_key != key:
+            return None
+        return cls(nodes, depth)
+
+    def save(self, fname, key):
+        # Written under a temporary name and renamed into place, as batch
+        # mode workers may be saving the same index.
+        tmpname = '%s.%d' % (fname, os.getpid())
+        with open(tmpname, 'wb') as f:
+            f.write(self.MAGIC)
+            marshal.dump((self.FORMAT, key, self.depth, self.nodes), f)
+        os.rename(tmpname, fname)
+
+    def match(self, data):
+        "Return the names of the longest signatures matching the start of data"
+        data = data[:self.depth]
+        nodes = self.nodes
+        best = []
+        best_depth = 0
+        stack = [(0, 0)]
+        while stack:
+            n, pos = stack.pop()
+            children, masked, names = nodes[n]
+            if names and pos >= best_depth:
+                if pos > best_depth:
+                    best = []
+                    best_depth = pos
+                best.extend(name for name in names if name not in best)
+            if pos == len(data):
+                continue
+            byte = ord(data[pos])
+            child = children.get(byte)
+            if child is not None:
+                stack.append((child, pos + 1))
+            for mask, value, child in masked:
+                if byte & mask == value:
+                    stack.append((child, pos + 1))
+        return best
+
+
+# Signature indexes loaded by this process, by database path
+_signature_indexes = {}
+
+
+def load_signature_index(pedb, index_file=DEFAULT_SIGINDEX_FILE):
+    """
+    Return the SignatureIndex for the PEiD database pedb. The database is
+    compiled once per process at most: the compiled index is saved to
+    index_file and reused while the database is unchanged.
+    """
+    pedb = os.path.abspath(pedb)
+    index = _signature_indexes.get(pedb)
+    if index is None:
+        st = os.stat(pedb)
+        key = (pedb, st.st_size, st.st_mtime)
+        index_file = os.path.expanduser(index_file)
+        index = SignatureIndex.load(index_file, key)
+        if index is None:
+            index = SignatureIndex.parse(pedb)
+            try:
+                index.save(index_file, key)
+            except (IOError, OSError) as e:
+                errs.append("WARNING: Unable to save PE signature index: %s" % e)
+        _signature_indexes[pedb] = index
+    return index
 
 
 class FileInfo(object):
@@ -57,7 +342,10 @@ class FileInfo(object):
     Provides container for storing and returning information pertaining to given
     file. Available information stored as attibutes on the object.
 
-    Basic information provided by aktlite library.
+    The file is memory mapped once; hashes are computed in a single pass over
+    the mapping (see hash_data()) and PE parsing reads from the same mapping.
+    Only the PE headers are parsed up front; data directories are parsed
+    when parse_verbose_info() needs them.
 
     If pefile is available, also attempt to parse file as PE and extract
     useful related information:
@@ -68,18 +356,29 @@ class FileInfo(object):
        environment
 
     """
-    def __init__(self, filepath):
+    def __init__(self, filepath, data=None, hashes=None):
         is_pe                 = False
         pe_sigs               = []
         pe_compiletime        = None
         pe_is_probably_packed = None
 
-        fileanalysis = atklite.FileAnalysis(filename=filepath).return_analysis()
-        cymru_mhr =  MHRChecker(hash)
+        # The caller may pass in the file's mapping and hashes if it already
+        # has them (see analyze()).
+        analyzetime = time.ctime()
+        if data is None:
+            data = map_file(filepath)
+        self._data = data
+        if hashes is None:
+            hashes = hash_data(self._data)
+        if MAGIC_MODULE:
+            filetype = magic.from_buffer(self._data[:MAGIC_BUFFER_SIZE])
+        else:
+            filetype = "[unavailable]"
 
         if PE_MODULE:
             try:
-                self._pe = pefile.PE(filepath)
+                self._pe = pefile.PE(data=self._data, fast_load=True)
+                self._pe_directories = set()
                 is_pe = True
                 pe_compiletime = "%s UTC" % time.asctime(time.gmtime(self._pe.FILE_HEADER.TimeDateStamp))
                 pe_is_probably_packed = peutils.is_probably_packed(self._pe)
@@ -93,120 +392,701 @@ class FileInfo(object):
                     pe_sigs.append("[unavailable]")
                 else:
                     try:
-                        signatures = peutils.SignatureDatabase(pedb)
-                        matches = signatures.match(self._pe, ep_only = True)
+                        signatures = load_signature_index(pedb)
+                    except (IOError, OSError):
+                        errs.append("ERROR: PE analysis requires valid path to a PE sig database in PEDBPATH.")
+                        pe_sigs.append("[unavailable]")
+                    else:
+                        matches = []
+                        ep = entry_point_offset(self._pe)
+                        if ep is not None:
+                            matches = signatures.match(self._data[ep:ep + signatures.depth])
                         if matches:
                             for id in matches:
                                 pe_sigs.append(id)
                         else:
                             pe_sigs.append("No matches")
-                    except IOError:
-                        errs.append("ERROR: PE analysis requires valid path to a PE sig database in PEDBPATH.")
-                        pe_sigs.append("[unavailable]")
             except pefile.PEFormatError as e:
                 is_pe = False
 
         self.filename              = basename(filepath)
-        self.analyzetime           = fileanalysis['analyzetime']
-        self.filesize              = fileanalysis['size']
-        self.filetype              = fileanalysis['ftype']
-        self.crc32                 = fileanalysis['crc32']
-        self.md5                   = fileanalysis['md5']
-        self.sha1                  = fileanalysis['sha1']
-        self.sha256                = fileanalysis['sha256']
-        self.ssdeep                = fileanalysis['ssdeep']
-        self.mhr                   = cymru_mhr.get_mhr_listing()
+        self.analyzetime           = analyzetime
+        self.filesize              = len(self._data)
+        self.filetype              = filetype
+        self.crc32                 = hashes['crc32']
+        self.md5                   = hashes['md5']
+        self.sha1                  = hashes['sha1']
+        self.sha256                = hashes['sha256']
+        self.ssdeep                = hashes['ssdeep']
+        # Set by the caller from an MHRResolver lookup
+        self.mhr                   = None
         self.is_pe                 = is_pe
         self.pe_compiletime        = pe_compiletime
         self.pe_is_probably_packed = pe_is_probably_packed
         self.pe_sigs               = pe_sigs
 
+    def _parse_directories(self, *names):
+        """
+        Parse the named PE data directories (e.g.
+        'IMAGE_DIRECTORY_ENTRY_IMPORT') unless already parsed.
+        """
+        todo = [name for name in names if name not in self._pe_directories]
+        if todo:
+            self._pe.parse_data_directories(
+                directories=[pefile.DIRECTORY_ENTRY[name] for name in todo])
+            self._pe_directories.update(todo)
+
     def parse_verbose_info(self):
+        """
+        Add PE section, import and export details:
+
+         - pe_sections: name, addresses, sizes and Shannon entropy of each
+           section's raw data
+         - pe_imports, pe_exports: imported and exported functions by DLL
+         - pe_imphash, pe_exphash: MD5 of the import and export names (None
+           if there are none)
+         - pe_overlay_size: bytes past the end of the PE image
+
+        """
         # XXX process self._pe for fileinfo.PE object
+        self._parse_directories('IMAGE_DIRECTORY_ENTRY_IMPORT', 'IMAGE_DIRECTORY_ENTRY_EXPORT')
+        pe = self._pe
 
         # Sections
-        pe_num_sections = self._pe.FILE_HEADER.NumberOfSections
+        pe_num_sections = pe.FILE_HEADER.NumberOfSections
         pe_sections = []
-        if pe_num_sections > 0:
-            for section in self._pe.sections:
-                section_info = "%s @%s (%s, %s)" % (section.Name.strip('\x00'), hex(section.VirtualAddress),
-                       hex(section.Misc_VirtualSize), section.SizeOfRawData )
-                pe_sections.append(section_info)
+        for section in pe.sections:
+            offset = section.PointerToRawData
+            pe_sections.append({
+                'name':            _pe_name(section.Name.strip('\x00')),
+                'virtual_address': section.VirtualAddress,
+                'virtual_size':    section.Misc_VirtualSize,
+                'raw_offset':      offset,
+                'raw_size':        section.SizeOfRawData,
+                'entropy':         round(shannon_entropy(byte_histogram(self._data, offset, section.SizeOfRawData)), 4),
+            })
 
         # Imports table
-        pe_import_data = StringIO()
-        print >> pe_import_data, ":: Imports:\n"
-        try:
-            for entry in self._pe.DIRECTORY_ENTRY_IMPORT:
-                print >> pe_import_data, entry.dll
-                for imp in entry.imports:
-                    print >> pe_import_data, "\t%s %s" % ( hex(imp.address), imp.name )
-        except:
-            print >> pe_import_data, "No imports."
+        pe_imports = []
+        for entry in getattr(pe, 'DIRECTORY_ENTRY_IMPORT', []):
+            pe_imports.append({
+                'dll':       _pe_name(entry.dll),
+                'functions': [{'address': imp.address, 'name': _pe_name(imp.name), 'ordinal': imp.ordinal}
+                              for imp in entry.imports],
+            })
+        pe_imphash = pe.get_imphash() if pe_imports else None
 
         # exports table
-        pe_export_data = StringIO()
-        print >> pe_export_data, ":: Exports:\n"
-        try:
+        pe_exports = []
+        export_names = []
+        if hasattr(pe, 'DIRECTORY_ENTRY_EXPORT'):
             for exp in pe.DIRECTORY_ENTRY_EXPORT.symbols:
-                print >> pe_export_data, "%s %s %s" % (hex(pe.OPTIONAL_HEADER.ImageBase + exp.address), exp.name, exp.ordinal)
-        except:
-            print >> pe_export_data, "No exports."
+                pe_exports.append({
+                    'address': pe.OPTIONAL_HEADER.ImageBase + exp.address,
+                    'name':    _pe_name(exp.name),
+                    'ordinal': exp.ordinal,
+                })
+                if exp.name:
+                    export_names.append(exp.name.lower())
+        pe_exphash = hashlib.md5(','.join(export_names)).hexdigest() if export_names else None
+
+        overlay_offset = pe.get_overlay_data_start_offset()
+        pe_overlay_size = len(self._data) - overlay_offset if overlay_offset is not None else 0
 
         self.pe_num_sections = pe_num_sections
         self.pe_sections     = pe_sections
-        self.pe_import_data  = pe_import_data
-        self.pe_export_data  = pe_export_data
+        self.pe_imports      = pe_imports
+        self.pe_imphash      = pe_imphash
+        self.pe_exports      = pe_exports
+        self.pe_exphash      = pe_exphash
+        self.pe_overlay_size = pe_overlay_size
+
+    @classmethod
+    def from_dict(cls, info):
+        """
+        Rebuild a FileInfo from to_dict() output, without access to the file.
+        """
+        file_info = cls.__new__(cls)
+        file_info.__dict__.update(info)
+        return file_info
+
+    def to_dict(self):
+        """
+        Return the analysis results as a dict of plain values, suitable for
+        JSON output.
+        """
+        info = {}
+        for name, value in vars(self).items():
+            if name.startswith('_'):
+                continue
+            info[name] = value
+        return info
+
+    def close(self):
+        "Release the file mapping and parsed PE, keeping the analysis results"
+        if hasattr(self._data, 'close'):
+            self._data.close()
+        self._data = self._pe = None
+
+
+def _dns_query(qid, name, qtype=16):
+    "Build a recursive DNS query for name (TXT by default)"
+    question = ''.join(chr(len(label)) + label for label in name.split('.')) + '\0'
+    question += struct.pack('>HH', qtype, 1)
+    return struct.pack('>HHHHHH', qid, 0x0100, 1, 0, 0, 0) + question, question
+
+
+def _dns_skip_name(msg, offset):
+    while True:
+        n = ord(msg[offset])
+        if n == 0:
+            return offset + 1
+        if n & 0xc0 == 0xc0:
+            return offset + 2
+        offset += n + 1
+
+
+def _dns_txt_answer(msg):
+    """
+    Return the response code and the first TXT record (its strings joined)
+    from a DNS response, or None for the record if there is none. Raises
+    ValueError if the response is malformed.
+    """
+    try:
+        flags, qdcount, ancount = struct.unpack('>HHH', msg[2:8])
+        offset = 12
+        for i in xrange(qdcount):
+            offset = _dns_skip_name(msg, offset) + 4
+        for i in xrange(ancount):
+            offset = _dns_skip_name(msg, offset)
+            rtype, rclass, ttl, rdlength = struct.unpack('>HHIH', msg[offset:offset + 10])
+            offset += 10
+            rdata = msg[offset:offset + rdlength]
+            offset += rdlength
+            if rtype == 16:
+                strings = []
+                i = 0
+                while i < len(rdata):
+                    n = ord(rdata[i])
+                    strings.append(rdata[i + 1:i + 1 + n])
+                    i += n + 1
+                return flags & 0xf, ''.join(strings)
+    except (struct.error, IndexError):
+        raise ValueError("malformed DNS response")
+    return flags & 0xf, None
+
+
+def format_mhr_listing(txt):
+    """
+    Format an MHR TXT record ("<last seen> <detection %>") for display.
+    None (not listed) and MHR_UNAVAILABLE are returned as is.
+    """
+    if txt is None or txt == MHR_UNAVAILABLE:
+        return txt
+    try:
+        ans = txt.split(" ")
+        return "%s%% (%s)" % (ans[1], time.ctime(int(ans[0])))
+    except (IndexError, ValueError):
+        return txt
+
+
+def default_nameserver(resolv_conf='/etc/resolv.conf'):
+    "Return the first nameserver in resolv_conf, or None"
+    try:
+        with open(resolv_conf) as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) > 1 and fields[0] == 'nameserver':
+                    return fields[1]
+    except IOError:
+        pass
+    return None
+
+
+def split_host_port(address, default_port):
+    "Split HOST, HOST:PORT, an IPv6 address or [IPV6]:PORT into (host, port)"
+    if address.startswith('['):
+        host, _, port = address[1:].partition(']')
+        port = port[1:] if port.startswith(':') else ''
+    elif address.count(':') == 1:
+        host, port = address.split(':')
+    else:
+        host, port = address, ''
+    return host, int(port) if port else default_port
+
+
+class MHRCache(object):
+    """
+    On-disk cache of MHR lookups, by hash. Listed hashes are kept for
+    positive_ttl seconds and unlisted ones for negative_ttl; failed lookups
+    are not cached.
+    """
+    def __init__(self, fname=DEFAULT_CACHE_FILE, positive_ttl=MHR_POSITIVE_TTL,
+                 negative_ttl=MHR_NEGATIVE_TTL):
+        self.db = sqlite3.connect(os.path.expanduser(fname), timeout=60)
+        self.db.text_factory = str
+        self.db.execute('CREATE TABLE IF NOT EXISTS mhr (hash TEXT PRIMARY KEY, '
+                        'listing TEXT, expires INTEGER)')
+        self.db.commit()
+        self.positive_ttl = positive_ttl
+        self.negative_ttl = negative_ttl
+
+    def get_many(self, hashes):
+        "Return {hash: TXT record or None} for the unexpired entries among hashes"
+        found = {}
+        now = int(time.time())
+        hashes = list(hashes)
+        for i in xrange(0, len(hashes), 500):
+            chunk = hashes[i:i + 500]
+            rows = self.db.execute('SELECT hash, listing FROM mhr WHERE expires > ? AND hash IN (%s)' %
+                                   ','.join('?' * len(chunk)), [now] + chunk)
+            found.update(rows)
+        return found
+
+    def put_many(self, listings):
+        now = int(time.time())
+        with self.db:
+            self.db.executemany('INSERT OR REPLACE INTO mhr VALUES (?, ?, ?)',
+                                [(h, txt, now + (self.positive_ttl if txt else self.negative_ttl))
+                                 for h, txt in listings.items()])
+
+    def close(self):
+        self.db.close()
 
 
-class MHRChecker(object):
+class MHRResolver(object):
     """
-    Query Team Cymru MHR service for file listing.
+    Query the Team Cymru Malware Hash Registry for many file hashes at once.
+    Queries are sent over UDP to nameserver ("host", "host:port" or
+    "[ipv6]:port", by default the first resolv.conf nameserver) with at
+    most concurrency in flight; each is retried up to retries times after
+    timeout seconds without an answer. Answers from any other address are
+    ignored. Answers are cached in cache (an MHRCache), if given.
     Sample listed hash for testing: 733a48a9cb49651d72fe824ca91e8d00
 
     """
-    def __init__(self, hash):
-        failstr = '[unavailable]'
-        if DNS_MODULE:
-            try:
-                DNS.ParseResolvConf()
-            except IOError:
+    def __init__(self, nameserver=None, concurrency=MHR_CONCURRENCY, timeout=MHR_TIMEOUT,
+                 retries=MHR_RETRIES, cache=None):
+        if nameserver is None:
+            nameserver = default_nameserver()
+            if nameserver is None:
                 errs.append("WARNING: Cannot determine DNS resolvers (required for MHR lookup).")
-                self.listing = failstr
+        self.server = None
+        if nameserver is not None:
+            host, port = split_host_port(nameserver, 53)
+            try:
+                addrinfo = socket.getaddrinfo(host, port, 0, socket.SOCK_DGRAM)[0]
+            except socket.gaierror as e:
+                errs.append("WARNING: Cannot resolve DNS server %s (required for MHR lookup): %s" %
+                            (nameserver, e.strerror))
             else:
-                r = DNS.DnsRequest(qtype='TXT')
-                # create query record based on hash
-                q = "%s.malware.hash.cymru.com" % hash
-                response = r.req(q)
-
-                if len(response.answers) > 0:
-                    ans = response.answers[0]['data'][0].split(" ")
-                    self.listing = "%s%% (%s)" % (ans[1], time.ctime(int(ans[0])))
-                else:
-                    self.listing = None
+                self.family, self.server = addrinfo[0], addrinfo[4]
+        self.concurrency = max(concurrency, 1)
+        self.timeout = timeout
+        self.retries = retries
+        self.cache = cache
+
+    def lookup(self, hashes):
+        """
+        Look up hashes, returning {hash: listing}, where a listing is
+        formatted by format_mhr_listing(): None for a hash that is not
+        listed and MHR_UNAVAILABLE if the lookup failed.
+        """
+        # Hashes from cached results (json) are unicode; queries need bytes.
+        hashes = set(str(h).lower() for h in hashes)
+        txts = {}
+        if self.cache is not None:
+            txts.update(self.cache.get_many(hashes))
+        todo = [h for h in hashes if h not in txts]
+        if todo:
+            if self.server is None:
+                fresh = dict((h, MHR_UNAVAILABLE) for h in todo)
+            else:
+                fresh = self._resolve(todo)
+            if self.cache is not None:
+                self.cache.put_many(dict((h, txt) for h, txt in fresh.items()
+                                         if txt != MHR_UNAVAILABLE))
+            txts.update(fresh)
+        return dict((h, format_mhr_listing(txt)) for h, txt in txts.items())
+
+    def _resolve(self, hashes):
+        sock = socket.socket(self.family, socket.SOCK_DGRAM)
+        sock.setblocking(0)
+        results = {}
+        pending = collections.deque(hashes)
+        # query id -> [hash, question, deadline, attempts]
+        inflight = {}
+
+        def send(h, attempts):
+            qid = random.randint(0, 0xffff)
+            while qid in inflight:
+                qid = random.randint(0, 0xffff)
+            packet, question = _dns_query(qid, "%s.%s" % (h, MHR_ZONE))
+            inflight[qid] = [h, question, time.time() + self.timeout, attempts]
+            try:
+                sock.sendto(packet, self.server)
+            except socket.error:
+                # Treated like a lost packet: retried after the timeout.
+                pass
+
+        def failed(q):
+            if q[3] <= self.retries:
+                send(q[0], q[3] + 1)
+            else:
+                results[q[0]] = MHR_UNAVAILABLE
+
+        try:
+            while pending or inflight:
+                while pending and len(inflight) < self.concurrency:
+                    send(pending.popleft(), 1)
+                wait = max(0, min(q[2] for q in inflight.values()) - time.time())
+                if select.select([sock], [], [], wait)[0]:
+                    while True:
+                        try:
+                            msg, addr = sock.recvfrom(4096)
+                        except socket.error as e:
+                            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                                break
+                            raise
+                        if addr[:2] != self.server[:2] or len(msg) < 12:
+                            continue
+                        qid = struct.unpack('>H', msg[:2])[0]
+                        q = inflight.get(qid)
+                        # Ignore stray and spoofed answers.
+                        if q is None or msg[12:12 + len(q[1])].lower() != q[1].lower():
+                            continue
+                        del inflight[qid]
+                        try:
+                            rcode, txt = _dns_txt_answer(msg)
+                        except ValueError:
+                            failed(q)
+                            continue
+                        if rcode == 0:
+                            results[q[0]] = txt
+                        elif rcode == 3:
+                            # NXDOMAIN: not listed
+                            results[q[0]] = None
+                        else:
+                            failed(q)
+                now = time.time()
+                for qid, q in inflight.items():
+                    if q[2] <= now:
+                        del inflight[qid]
+                        failed(q)
+        finally:
+            sock.close()
+        return results
+
+
+def _decode_strings(value):
+    "Decode the byte strings in value as UTF-8, replacing invalid bytes"
+    if isinstance(value, str):
+        return value.decode('utf-8', 'replace')
+    if isinstance(value, dict):
+        return dict((_decode_strings(k), _decode_strings(v)) for k, v in value.items())
+    if isinstance(value, (list, tuple)):
+        return [_decode_strings(v) for v in value]
+    return value
+
+
+def to_json(value):
+    """
+    Serialize value as JSON. File names need not be valid UTF-8, so byte
+    strings that are not are decoded with invalid bytes replaced.
+    """
+    try:
+        return json.dumps(value, sort_keys=True)
+    except UnicodeDecodeError:
+        return json.dumps(_decode_strings(value), sort_keys=True)
+
+
+def cache_key():
+    """
+    Identify the analyzer setup that cached results depend on: the analyzer
+    version, which optional modules are available and the PEiD signature
+    database in use.
+    """
+    pedb = os.environ.get('PEDBPATH')
+    pedb_id = None
+    if pedb and os.path.exists(pedb):
+        st = os.stat(pedb)
+        pedb_id = [os.path.abspath(pedb), st.st_size, st.st_mtime]
+    return json.dumps([ANALYZER_VERSION, MAGIC_MODULE, SSDEEP_MODULE, PE_MODULE, pedb_id])
+
+
+class AnalysisCache(object):
+    """
+    On-disk cache of FileInfo results. Results are stored by SHA256 of the
+    file contents, and files by (device, inode, size, mtime), so an
+    unchanged file is found without reading it and a renamed or copied file
+    is found once it has been hashed. The whole cache is cleared when
+    cache_key() changes.
+    """
+    def __init__(self, fname=DEFAULT_CACHE_FILE):
+        # Batch mode workers share the cache; wait out each other's writes.
+        self.db = sqlite3.connect(os.path.expanduser(fname), timeout=60)
+        self.db.text_factory = str
+        self.db.execute('CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS results (sha256 TEXT PRIMARY KEY, '
+                        'verbose INTEGER, info TEXT)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS files (dev INTEGER, ino INTEGER, '
+                        'size INTEGER, mtime REAL, sha256 TEXT, PRIMARY KEY (dev, ino))')
+        key = cache_key()
+        row = self.db.execute("SELECT value FROM meta WHERE name = 'key'").fetchone()
+        if row is None or row[0] != key:
+            self.db.execute('DELETE FROM results')
+            self.db.execute('DELETE FROM files')
+            self.db.execute("INSERT OR REPLACE INTO meta VALUES ('key', ?)", (key,))
+        self.db.commit()
+
+    def lookup_stat(self, st, verbose=0):
+        row = self.db.execute('SELECT r.info FROM files f JOIN results r USING (sha256) '
+                              'WHERE f.dev = ? AND f.ino = ? AND f.size = ? AND f.mtime = ? '
+                              'AND r.verbose >= ?',
+                              (st.st_dev, st.st_ino, st.st_size, st.st_mtime, verbose)).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0])
+
+    def lookup_hash(self, sha256, verbose=0):
+        row = self.db.execute('SELECT info FROM results WHERE sha256 = ? AND verbose >= ?',
+                              (sha256, verbose)).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0])
+
+    def put(self, st, sha256, info=None, verbose=0):
+        with self.db:
+            if info is not None:
+                self.db.execute('INSERT OR REPLACE INTO results VALUES (?, ?, ?)',
+                                (sha256, verbose, to_json(info)))
+            self.db.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?)',
+                            (st.st_dev, st.st_ino, st.st_size, st.st_mtime, sha256))
+
+    def close(self):
+        self.db.close()
+
+
+def analyze(filepath, verbose=0, cache=None):
+    """
+    Return a FileInfo for filepath, parsing PE details as well if verbose is
+    above 1. With a cache, results are reused for a file whose stat is
+    unchanged (without reading it) or whose contents were seen before.
+    The file is closed before returning.
+    """
+    if cache is None:
+        file_info = FileInfo(filepath)
+        if verbose > 1 and file_info.is_pe:
+            file_info.parse_verbose_info()
+        file_info.close()
+        return file_info
+
+    st = os.stat(filepath)
+    info = cache.lookup_stat(st, verbose)
+    if info is None:
+        data = map_file(filepath)
+        hashes = hash_data(data)
+        info = cache.lookup_hash(hashes['sha256'], verbose)
+        if info is None:
+            file_info = FileInfo(filepath, data, hashes)
+            if verbose > 1 and file_info.is_pe:
+                file_info.parse_verbose_info()
+            file_info.close()
+            cache.put(st, file_info.sha256, file_info.to_dict(), verbose)
+            return file_info
+        if hasattr(data, 'close'):
+            data.close()
+        cache.put(st, hashes['sha256'])
+
+    file_info = FileInfo.from_dict(info)
+    file_info.filename = basename(filepath)
+    return file_info
+
+
+# Per-process cache connections for batch mode workers, by file name
+_worker_caches = {}
+
+
+def find_files(paths):
+    """
+    Yield (size, path) for each file named in paths or found under a
+    directory in paths, recursively. A path that cannot be read is yielded
+    with a size of None.
+    """
+    for path in paths:
+        if os.path.isdir(path):
+            for dirpath, dirnames, filenames in os.walk(path):
+                dirnames.sort()
+                for name in sorted(filenames):
+                    filepath = os.path.join(dirpath, name)
+                    if os.path.isfile(filepath):
+                        yield os.path.getsize(filepath), filepath
+        elif os.path.isfile(path):
+            yield os.path.getsize(path), path
         else:
-            self.listing = failstr
+            yield None, path
 
-    def get_mhr_listing(self):
-        return self.listing
+
+def analyze_file(filepath, verbose=0, cache_file=None):
+    """
+    Analyze one file for batch mode, returning the FileInfo results as a
+    dict. Any failure is returned as an error in the dict rather than
+    raised, so one bad file does not stop the batch.
+    """
+    try:
+        cache = None
+        if cache_file:
+            cache = _worker_caches.get(cache_file)
+            if cache is None:
+                cache = _worker_caches[cache_file] = AnalysisCache(cache_file)
+        info = analyze(filepath, verbose, cache).to_dict()
+    except Exception as e:
+        info = {'error': "%s: %s" % (e.__class__.__name__, e)}
+    info['path'] = filepath
+    return info
+
+
+def run_batch(paths, jobs, verbose=0, cache_file=None, resolver=None, out=sys.stdout):
+    """
+    Analyze every file found under paths across a pool of jobs processes,
+    largest files first so that big files do not hold up the end of the
+    run. Results are cached in cache_file, if given. One JSON record per
+    file is written to out as each finishes, with progress and a final
+    summary on stderr. With an MHRResolver, finished records are held
+    briefly so their hashes can be looked up in batches.
+    """
+    files = []
+    missing = 0
+    for size, path in find_files(paths):
+        if size is None:
+            out.write(to_json({"error": "file does not exist", "path": path}) + "\n")
+            missing += 1
+        else:
+            files.append((size, path))
+    files.sort(reverse=True)
+    total = len(files) + missing
+    total_bytes = sum(size for size, path in files)
+
+    if cache_file:
+        # Clear out stale results once, before the workers open the cache.
+        AnalysisCache(cache_file).close()
+
+    if PE_MODULE and os.environ.get('PEDBPATH'):
+        # Load the signature index before forking so the workers share it.
+        try:
+            load_signature_index(os.environ['PEDBPATH'])
+        except (IOError, OSError):
+            pass
+
+    batch = []
+
+    def write_batch():
+        if resolver is not None:
+            listings = resolver.lookup([info['md5'] for info in batch if 'md5' in info])
+            for info in batch:
+                if 'md5' in info:
+                    info['mhr'] = listings[info['md5']]
+        for info in batch:
+            # One unwritable record must not stop the batch.
+            try:
+                line = to_json(info)
+            except (TypeError, ValueError) as e:
+                line = to_json({'error': "%s: %s" % (e.__class__.__name__, e), 'path': info.get('path')})
+            out.write(line + "\n")
+        out.flush()
+        del batch[:]
+
+    start = time.time()
+    done = failed = missing
+    pool = multiprocessing.Pool(jobs)
+    try:
+        results = pool.imap_unordered(functools.partial(analyze_file, verbose=verbose,
+                                                        cache_file=cache_file),
+                                      [path for size, path in files])
+        batch_start = None
+        while True:
+            wait = None
+            if batch:
+                wait = max(0, batch_start + MHR_BATCH_WAIT - time.time())
+            try:
+                info = results.next(wait)
+            except multiprocessing.TimeoutError:
+                write_batch()
+                continue
+            except StopIteration:
+                break
+            if not batch:
+                batch_start = time.time()
+            batch.append(info)
+            if resolver is None or len(batch) >= MHR_BATCH_SIZE:
+                write_batch()
+            done += 1
+            if 'error' in info:
+                failed += 1
+            sys.stderr.write("\rfile-info: %d/%d files" % (done, total))
+        write_batch()
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+    elapsed = time.time() - start
+    if files:
+        sys.stderr.write("\n")
+    sys.stderr.write("file-info: %d files (%d failed), %d bytes in %.1f s: %.1f files/s, %.1f MB/s\n" %
+                     (done, failed, total_bytes, elapsed, done / elapsed if elapsed else 0,
+                      total_bytes / elapsed / 1048576 if elapsed else 0))
 
 
 def main():
     # parse options
-    usage = "usage: %prog [options] file"
+    usage = "usage: %prog [options] file ...\n       %prog -b [options] file|directory ..."
     parser = OptionParser(usage)
     parser.add_option("-v", "--verbose", action="count", dest="verbose",
                       help="display warnings and errors; if used more than once, display more details for PE files")
+    parser.add_option("-b", "--batch", action="store_true", dest="batch", default=False,
+                      help="analyze files and directories recursively in parallel, writing one JSON record per file")
+    parser.add_option("-j", "--jobs", type="int", dest="jobs", default=multiprocessing.cpu_count(),
+                      help="number of worker processes in batch mode (default: number of CPUs)")
+    parser.add_option("-c", "--cache-file", dest="cache_file", default=DEFAULT_CACHE_FILE,
+                      help="file to cache analysis results in (default: %s)" % DEFAULT_CACHE_FILE)
+    parser.add_option("-n", "--no-cache", action="store_true", dest="no_cache", default=False,
+                      help="do not use or update the analysis result cache")
+    parser.add_option("-M", "--no-mhr", action="store_true", dest="no_mhr", default=False,
+                      help="do not look up files in the Team Cymru Malware Hash Registry")
+    parser.add_option("-s", "--mhr-server", dest="mhr_server",
+                      help="DNS server (HOST[:PORT] or [IPV6]:PORT) for MHR lookups (default: first resolv.conf nameserver)")
     (options, args) = parser.parse_args()
 
-    for file in args:
-        if not os.path.exists(file):
-            print >> sys.stderr, "ERROR: specified file does not exist."
-            sys.exit(1)
+    cache_file = None if options.no_cache else options.cache_file
 
-        file_info = FileInfo(file)
-        if options.verbose > 1:
-            file_info.parse_verbose_info()
+    resolver = None
+    if not options.no_mhr:
+        resolver = MHRResolver(options.mhr_server, cache=MHRCache(cache_file) if cache_file else None)
+
+    if options.batch:
+        if options.verbose:
+            for e in errs:
+                print >> sys.stderr, ">> %s" % e
+        run_batch(args, max(options.jobs, 1), options.verbose or 0, cache_file, resolver)
+        return
+
+    cache = AnalysisCache(cache_file) if cache_file else None
+
+    file_infos = []
+
+    def print_file_infos():
+        # Look up the files' hashes at once
+        if resolver is not None:
+            listings = resolver.lookup([file_info.md5 for file_info in file_infos])
+            for file_info in file_infos:
+                file_info.mhr = listings[file_info.md5]
+        for file_info in file_infos:
+            print_file_info(file_info)
+        sys.stdout.flush()
+        del file_infos[:]
+
+    def print_file_info(file_info):
 
         # display output of any errors that have occurred in single block before output
         if len(errs) > 0:
@@ -241,6 +1121,16 @@ def main():
         #if options.verbose > 1 and PE_MODULE:
         #    show_pe_data(file)
 
+    for file in args:
+        if not os.path.exists(file):
+            print_file_infos()
+            print >> sys.stderr, "ERROR: specified file does not exist."
+            sys.exit(1)
+        file_infos.append(analyze(file, options.verbose or 0, cache))
+        if resolver is None or len(file_infos) >= MHR_PRINT_BATCH_SIZE:
+            print_file_infos()
+    print_file_infos()
+
 if __name__ == "__main__":
     main()
 
@@ -0,0 +1,173 @@
+#!/usr/bin/env python2
+
+# Copyright (c) 2026 Darren Spruell <phatbuckett@gmail.com>
+#
+# Permission to use, copy, modify, and distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+# Local stand-in for the Team Cymru Malware Hash Registry DNS service, for
+# testing and benchmarking file-info.py MHR lookups.
+#
+# Answers UDP TXT queries for <hash>.malware.hash.cymru.com with
+# "<last seen> <detection %>" for listed hashes and NXDOMAIN otherwise.
+# Listed hashes come from a file (-f, lines of "hash [timestamp percent]")
+# and/or a deterministic fraction of all hashes (-r). Latency and packet
+# loss can be injected.
+# Pass the HOST:PORT printed on startup to file-info.py --mhr-server.
+
+import hashlib
+import heapq
+import optparse
+import random
+import select
+import socket
+import struct
+import sys
+import time
+
+MHR_ZONE = 'malware.hash.cymru.com'
+LAST_SEEN = 1262304000  # 2010-01-01
+
+options = None
+listings = {}
+
+
+def load_listings(fname):
+    with open(fname) as f:
+        for line in f:
+            fields = line.split()
+            if not fields or fields[0].startswith('#'):
+                continue
+            if len(fields) >= 3:
+                listings[fields[0].lower()] = '%s %s' % (fields[1], fields[2])
+            else:
+                listings[fields[0].lower()] = '%d 50' % LAST_SEEN
+
+
+def listing(h):
+    "Return the TXT record for hash h, or None if it is not listed"
+    if h in listings:
+        return listings[h]
+    if options.ratio:
+        # Derive listing from the hash so answers are stable across runs.
+        n = int(hashlib.md5(h).hexdigest()[:8], 16)
+        if n < options.ratio * 0xffffffff:
+            return '%d %d' % (LAST_SEEN + n % 86400000, n % 100 + 1)
+    return None
+
+
+def parse_question(msg):
+    "Return the query name (lowercased) and the question section of msg"
+    labels = []
+    offset = 12
+    while True:
+        n = ord(msg[offset])
+        if n == 0:
+            break
+        labels.append(msg[offset + 1:offset + 1 + n])
+        offset += n + 1
+    offset += 5
+    return '.'.join(labels).lower(), msg[12:offset]
+
+
+def answer(msg):
+    "Build the response to query msg"
+    qid, flags = struct.unpack('>HH', msg[:4])
+    name, question = parse_question(msg)
+    qtype = struct.unpack('>H', question[-4:-2])[0]
+    txt = None
+    rcode = 3
+    if name.endswith('.' + MHR_ZONE):
+        txt = listing(name[:-len(MHR_ZONE) - 1])
+        if txt is not None:
+            rcode = 0
+    flags = 0x8000 | (flags & 0x0100) | 0x0080 | rcode
+    ancount = 1 if txt is not None and qtype == 16 else 0
+    resp = struct.pack('>HHHHHH', qid, flags, 1, ancount, 0, 0) + question
+    if ancount:
+        rdata = chr(len(txt)) + txt
+        # Name is a pointer to the question
+        resp += struct.pack('>HHHIH', 0xc00c, 16, 1, 3600, len(rdata)) + rdata
+    return resp
+
+
+def serve(sock):
+    # Replies held back for the injected latency, as (due, seq, data, addr)
+    delayed = []
+    seq = 0
+    while True:
+        wait = None
+        if delayed:
+            wait = max(0, delayed[0][0] - time.time())
+        if select.select([sock], [], [], wait)[0]:
+            msg, addr = sock.recvfrom(4096)
+            try:
+                resp = answer(msg)
+            except (IndexError, struct.error):
+                continue
+            if options.verbose:
+                sys.stderr.write('%s:%d %s\n' % (addr[0], addr[1], parse_question(msg)[0]))
+            if random.random() < options.drop_rate:
+                continue
+            if options.latency:
+                seq += 1
+                heapq.heappush(delayed, (time.time() + options.latency, seq, resp, addr))
+            else:
+                sock.sendto(resp, addr)
+        now = time.time()
+        while delayed and delayed[0][0] <= now:
+            due, n, resp, addr = heapq.heappop(delayed)
+            sock.sendto(resp, addr)
+
+
+def main():
+    global options
+
+    parser = optparse.OptionParser()
+    parser.add_option('-a', '--address', dest='address', default='127.0.0.1',
+        help='address to listen on (default: 127.0.0.1)')
+    parser.add_option('-p', '--port', dest='port', type='int', default=5353,
+        help='UDP port to listen on, 0 for any free port (default: 5353)')
+    parser.add_option('-f', '--listings', dest='listings',
+        help='file of listed hashes, one "hash [timestamp percent]" per line')
+    parser.add_option('-r', '--ratio', dest='ratio', type='float', default=0,
+        help='fraction of all other hashes to report as listed')
+    parser.add_option('-l', '--latency', dest='latency', type='float', default=0,
+        help='seconds to wait before answering')
+    parser.add_option('-d', '--drop-rate', dest='drop_rate', type='float', default=0,
+        help='fraction of queries to leave unanswered')
+    parser.add_option('-s', '--seed', dest='seed', type='int',
+        help='random seed for packet loss')
+    parser.add_option('-v', '--verbose', dest='verbose', action='store_true', default=False,
+        help='log queries to stderr')
+    options, args = parser.parse_args()
+    if args:
+        parser.print_help()
+        sys.exit(1)
+
+    random.seed(options.seed)
+    if options.listings:
+        load_listings(options.listings)
+    family = socket.AF_INET6 if ':' in options.address else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_DGRAM)
+    sock.bind((options.address, options.port))
+    host, port = sock.getsockname()[:2]
+    sys.stdout.write(('[%s]:%d\n' if ':' in host else '%s:%d\n') % (host, port))
+    sys.stdout.flush()
+    serve(sock)
+
+
+if __name__ == '__main__':
+    try:
+        main()
+    except KeyboardInterrupt:
+        pass
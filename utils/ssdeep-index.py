@@ -0,0 +1,216 @@
+#!/usr/bin/env python2
+
+# Copyright (c) 2026 Darren Spruell <phatbuckett@gmail.com>
+#
+# Permission to use, copy, modify, and distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+# Find similar files by ssdeep fuzzy hash without comparing every pair.
+#
+# Two ssdeep digests only score above zero when their block sizes are equal
+# or a factor of two apart and their hashes for a common block size share a
+# run of 7 characters. Each digest is indexed by (block size, 7-gram) for
+# both of its hashes, so the candidates for a query are found by index
+# lookups and only those are compared with ssdeep. A hash shorter than 7
+# characters is indexed whole, as ssdeep still scores identical digests.
+#
+# Usage: ssdeep-index.py [options] add FILE...
+#        ssdeep-index.py [options] query FILE...
+#        ssdeep-index.py [options] cluster
+#
+# add indexes files, query lists indexed files similar to each file and
+# cluster prints groups of similar indexed files, one "cluster<TAB>name"
+# line per file. With -i, FILE arguments are file-info.py -b output
+# ("-" for stdin) rather than files to hash.
+
+import json
+import optparse
+import os
+import re
+import sqlite3
+import sys
+
+import ssdeep
+
+NGRAM = 7
+DEFAULT_INDEX_FILE = '~/.ssdeep-index.db'
+DEFAULT_THRESHOLD = 50
+
+# ssdeep ignores runs of more than three identical characters
+_runs = re.compile(r'(.)\1{3,}')
+
+
+def parse_digest(digest):
+    "Split a digest (optionally with ssdeep's ,\"filename\" suffix) into its parts"
+    blocksize, hash1, hash2 = digest.split(':', 2)
+    return int(blocksize), hash1, hash2.split(',', 1)[0]
+
+
+def index_keys(digest):
+    "Return the (block size, 7-gram or whole short hash) keys for digest"
+    blocksize, hash1, hash2 = parse_digest(digest)
+    keys = set()
+    for size, h in ((blocksize, hash1), (blocksize * 2, hash2)):
+        h = _runs.sub(r'\1\1\1', h)
+        if 0 < len(h) < NGRAM:
+            keys.add((size, h))
+        for i in xrange(len(h) - NGRAM + 1):
+            keys.add((size, h[i:i + NGRAM]))
+    return keys
+
+
+class SimilarityIndex(object):
+    """
+    On-disk index of ssdeep digests by name, searchable for similar digests.
+    """
+    def __init__(self, fname=DEFAULT_INDEX_FILE):
+        self.db = sqlite3.connect(os.path.expanduser(fname))
+        self.db.text_factory = str
+        self.db.execute('CREATE TABLE IF NOT EXISTS digests (id INTEGER PRIMARY KEY, '
+                        'name TEXT UNIQUE, digest TEXT)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS grams (blocksize INTEGER, gram TEXT, id INTEGER)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS grams_key ON grams (blocksize, gram)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS grams_id ON grams (id)')
+        self.db.commit()
+
+    def add(self, name, digest):
+        "Index digest under name, replacing any digest already indexed for name"
+        row = self.db.execute('SELECT id, digest FROM digests WHERE name = ?', (name,)).fetchone()
+        if row is not None:
+            if row[1] == digest:
+                return
+            self.db.execute('DELETE FROM grams WHERE id = ?', (row[0],))
+            self.db.execute('DELETE FROM digests WHERE id = ?', (row[0],))
+        digest_id = self.db.execute('INSERT INTO digests (name, digest) VALUES (?, ?)',
+                                    (name, digest)).lastrowid
+        self.db.executemany('INSERT INTO grams VALUES (?, ?, ?)',
+                            [(size, gram, digest_id) for size, gram in index_keys(digest)])
+
+    def candidates(self, digest):
+        "Return the ids of indexed digests sharing a 7-gram with digest"
+        ids = set()
+        for key in index_keys(digest):
+            ids.update(row[0] for row in
+                       self.db.execute('SELECT id FROM grams WHERE blocksize = ? AND gram = ?', key))
+        return ids
+
+    def similar(self, digest, threshold=DEFAULT_THRESHOLD):
+        "Return [(score, name)] for indexed digests scoring at least threshold, best first"
+        matches = []
+        for digest_id in self.candidates(digest):
+            name, other = self.db.execute('SELECT name, digest FROM digests WHERE id = ?',
+                                          (digest_id,)).fetchone()
+            score = ssdeep.compare(digest, other)
+            if score >= threshold:
+                matches.append((score, name))
+        matches.sort(key=lambda m: (-m[0], m[1]))
+        return matches
+
+    def clusters(self, threshold=DEFAULT_THRESHOLD):
+        """
+        Group indexed digests into clusters linked by pairs scoring at least
+        threshold, returning lists of names, largest cluster first. Digests
+        with no similar digest are left out.
+        """
+        parent = {}
+
+        def find(x):
+            while parent.get(x, x) != x:
+                parent[x] = parent.get(parent[x], parent[x])
+                x = parent[x]
+            return x
+
+        digests = dict(self.db.execute('SELECT id, digest FROM digests'))
+        for digest_id, digest in digests.iteritems():
+            for other_id in self.candidates(digest):
+                if other_id <= digest_id or find(other_id) == find(digest_id):
+                    continue
+                if ssdeep.compare(digest, digests[other_id]) >= threshold:
+                    root = find(digest_id)
+                    parent[root] = root
+                    parent[find(other_id)] = root
+
+        groups = {}
+        for digest_id in parent:
+            groups.setdefault(find(digest_id), []).append(digest_id)
+        names = dict(self.db.execute('SELECT id, name FROM digests'))
+        clusters = [sorted(names[i] for i in ids) for ids in groups.values()]
+        clusters.sort(key=lambda c: (-len(c), c[0]))
+        return clusters
+
+    def commit(self):
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+
+def read_digests(args, from_records=False):
+    """
+    Yield (name, digest) for each file in args, or with from_records for
+    each record in the file-info.py -b output files in args.
+    """
+    for arg in args:
+        if not from_records:
+            yield arg, ssdeep.hash_from_file(arg)
+            continue
+        fp = sys.stdin if arg == '-' else open(arg)
+        for line in fp:
+            info = json.loads(line)
+            digest = info.get('ssdeep')
+            if digest and ':' in digest:
+                yield info['path'], digest
+        if fp is not sys.stdin:
+            fp.close()
+
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [options] add|query FILE...\n'
+                                         '       %prog [options] cluster')
+    parser.add_option('-d', '--index', dest='index', default=DEFAULT_INDEX_FILE,
+        help='index file (default: %s)' % DEFAULT_INDEX_FILE)
+    parser.add_option('-t', '--threshold', dest='threshold', type='int', default=DEFAULT_THRESHOLD,
+        help='minimum ssdeep score for files to be similar (default: %d)' % DEFAULT_THRESHOLD)
+    parser.add_option('-i', '--records', dest='records', action='store_true', default=False,
+        help='read digests from file-info.py -b output instead of hashing files')
+    options, args = parser.parse_args()
+    if not args or args[0] not in ('add', 'query', 'cluster') or \
+            (args[0] == 'cluster') != (len(args) == 1):
+        parser.print_help()
+        sys.exit(1)
+    command = args.pop(0)
+    threshold = max(options.threshold, 1)
+
+    index = SimilarityIndex(options.index)
+    try:
+        if command == 'add':
+            for name, digest in read_digests(args, options.records):
+                index.add(name, digest)
+            index.commit()
+        elif command == 'query':
+            for name, digest in read_digests(args, options.records):
+                for score, match in index.similar(digest, threshold):
+                    if match != name:
+                        print '%s\t%d\t%s' % (name, score, match)
+        else:
+            for n, cluster in enumerate(index.clusters(threshold), 1):
+                for name in cluster:
+                    print '%d\t%s' % (n, name)
+    finally:
+        index.close()
+
+
+if __name__ == '__main__':
+    try:
+        main()
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,158 @@
+#!/usr/bin/env python2
+
+# Tests for file-info.py. Run with: python2 -m unittest test_file_info
+
+import imp
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import unittest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+file_info = imp.load_source('file_info', os.path.join(HERE, 'file-info.py'))
+mhr_stub_dns = imp.load_source('mhr_stub_dns', os.path.join(HERE, 'mhr-stub-dns.py'))
+
+
+class SplitHostPortTest(unittest.TestCase):
+    def test_forms(self):
+        for address, expected in (('192.0.2.1', ('192.0.2.1', 53)),
+                                  ('192.0.2.1:5353', ('192.0.2.1', 5353)),
+                                  ('ns.example.com:5353', ('ns.example.com', 5353)),
+                                  ('2001:db8::1', ('2001:db8::1', 53)),
+                                  ('[2001:db8::1]', ('2001:db8::1', 53)),
+                                  ('[::1]:5353', ('::1', 5353))):
+            self.assertEqual(file_info.split_host_port(address, 53), expected)
+
+
+class SignatureIndexTest(unittest.TestCase):
+    signatures = [('Exact', 'E8 00 00 00 00 5D'),
+                  ('Wildcard', 'E8 ?? 00 00 00 5D 81'),
+                  ('Nibbles', '6? ?8 B? ?0 9? ?1 E8'),
+                  ('Not entry point', '60 E8', 'false')]
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.pedb = os.path.join(self.tmpdir, 'userdb.txt')
+        with open(self.pedb, 'w') as f:
+            for sig in self.signatures:
+                name, signature = sig[:2]
+                ep_only = sig[2] if len(sig) > 2 else 'true'
+                f.write('[%s]\nsignature = %s\nep_only = %s\n\n' % (name, signature, ep_only))
+        self.index = file_info.SignatureIndex.parse(self.pedb)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_match(self):
+        match = self.index.match
+        self.assertEqual(match('\xe8\x00\x00\x00\x00\x5d\x90'), ['Exact'])
+        self.assertEqual(match('\xe8\x07\x00\x00\x00\x5d\x81'), ['Wildcard'])
+        self.assertEqual(match('\xe8\x00\x00\x00\x00\x5d\x81'), ['Wildcard'])
+        self.assertEqual(match('\x6f\x18\xb3\xa0\x9c\xf1\xe8'), ['Nibbles'])
+        self.assertEqual(match('\x60\x18\xb0\x00\x90\x01\xe8'), ['Nibbles'])
+        self.assertEqual(match('\x70\x18\xb3\xa0\x9c\xf1\xe8'), [])
+        self.assertEqual(match('\x6f\x19\xb3\xa0\x9c\xf1\xe8'), [])
+        self.assertEqual(match('\x6f\x18\xb3\xa0\x9c\xf1'), [])
+        self.assertEqual(match('\x60\xe8'), [])
+
+    def test_nibble_wildcards_do_not_multiply_nodes(self):
+        # The root and one node per token, the shared E8 prefix counted once
+        self.assertEqual(len(self.index.nodes), 1 + 6 + (7 - 1) + 7)
+
+    def test_save_and_load(self):
+        fname = os.path.join(self.tmpdir, 'sigidx')
+        self.index.save(fname, 'key')
+        self.assertEqual(file_info.SignatureIndex.load(fname, 'other key'), None)
+        index = file_info.SignatureIndex.load(fname, 'key')
+        self.assertEqual(index.match('\x6f\x18\xb3\xa0\x9c\xf1\xe8'), ['Nibbles'])
+
+
+class MHRLookupTest(unittest.TestCase):
+    unlisted = 'd41d8cd98f00b204e9800998ecf8427e'
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.sample = os.path.join(self.tmpdir, 'sample')
+        with open(self.sample, 'wb') as f:
+            f.write('file-info test sample\n')
+        self.md5 = file_info.hash_data(file_info.map_file(self.sample))['md5']
+        self.listings = os.path.join(self.tmpdir, 'listings')
+        with open(self.listings, 'w') as f:
+            f.write('%s 1262304000 42\n' % self.md5)
+        self.servers = []
+        self.address = self.start_server('127.0.0.1')
+
+    def tearDown(self):
+        for server in self.servers:
+            server.kill()
+            server.wait()
+        shutil.rmtree(self.tmpdir)
+
+    def start_server(self, address):
+        "Start mhr-stub-dns.py on address, returning the address to query"
+        server = subprocess.Popen([sys.executable, os.path.join(HERE, 'mhr-stub-dns.py'),
+                                   '-a', address, '-p', '0', '-f', self.listings],
+                                  stdout=subprocess.PIPE)
+        self.servers.append(server)
+        return server.stdout.readline().strip()
+
+    def test_cached_analysis_with_cold_mhr_entry(self):
+        cache_file = os.path.join(self.tmpdir, 'cache')
+        cache = file_info.AnalysisCache(cache_file)
+        file_info.analyze(self.sample, cache=cache)
+        cached = file_info.analyze(self.sample, cache=cache)
+        self.assertIsInstance(cached.md5, unicode)
+
+        mhr_cache = file_info.MHRCache(cache_file)
+        mhr_cache.put_many({self.md5: None})
+        mhr_cache.db.execute('UPDATE mhr SET expires = 0')
+        resolver = file_info.MHRResolver(self.address, timeout=1.0, cache=mhr_cache)
+        listings = resolver.lookup([cached.md5, self.unlisted])
+        self.assertEqual(listings[cached.md5], file_info.format_mhr_listing('1262304000 42'))
+        self.assertEqual(listings[self.unlisted], None)
+
+    def test_ipv6_server(self):
+        address = self.start_server('::1')
+        self.assertTrue(address.startswith('[::1]:'))
+        resolver = file_info.MHRResolver(address, timeout=1.0)
+        self.assertEqual(resolver.lookup([self.md5])[self.md5],
+                         file_info.format_mhr_listing('1262304000 42'))
+
+    def answer_from(self, reply_address):
+        """
+        Look up self.md5 through a server that answers from reply_address
+        rather than the address it was queried on.
+        """
+        mhr_stub_dns.load_listings(self.listings)
+        server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        server.bind(('127.0.0.1', 0))
+        replier = server
+        if reply_address is not None:
+            replier = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            replier.bind((reply_address, 0))
+
+        def serve():
+            msg, addr = server.recvfrom(4096)
+            replier.sendto(mhr_stub_dns.answer(msg), addr)
+
+        thread = threading.Thread(target=serve)
+        thread.start()
+        try:
+            resolver = file_info.MHRResolver('%s:%d' % server.getsockname(), timeout=1.0, retries=0)
+            return resolver.lookup([self.md5])[self.md5]
+        finally:
+            thread.join()
+            server.close()
+            replier.close()
+
+    def test_ignores_answers_from_other_addresses(self):
+        self.assertEqual(self.answer_from(None), file_info.format_mhr_listing('1262304000 42'))
+        self.assertEqual(self.answer_from('127.0.0.2'), file_info.MHR_UNAVAILABLE)
+
+
+if __name__ == '__main__':
+    unittest.main()